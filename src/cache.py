@@ -1,9 +1,13 @@
 import logging
 import itertools
+import os
+import pickle
+from array import array
+from bisect import bisect_left, bisect_right
 from datetime import datetime, timedelta
-from threading import RLock
 
 from src.globals import *
+from src.util import InstrumentedLock
 
 class CachedMessage():
 	__slots__ = ('user_id', 'time', 'warned', 'upvoted', 'downvoted')
@@ -14,7 +18,7 @@ class CachedMessage():
 		self.upvoted = set() # set of users that have given this message karma
 		self.downvoted = set() # set of users that have taken this message karma
 	def isExpired(self):
-		return datetime.now() >= self.time + timedelta(hours=24)
+		return datetime.now() >= self.time + CACHE_DURATION
 	def hasUpvoted(self, user):
 		return user.id in self.upvoted
 	def hasDownvoted(self, user):
@@ -24,62 +28,370 @@ class CachedMessage():
 	def addDownvote(self, user):
 		self.downvoted.add(user.id)
 
-class Cache():
+# how long messages are kept in cache
+CACHE_DURATION = timedelta(hours=24)
+# how many messages are expired before the lock is released again
+EXPIRE_BATCH_SIZE = 1000
+# rough memory cost of a cached message and of a single mapping, in bytes
+MESSAGE_BYTES = 800
+MAPPING_BYTES = 24
+# number of independently locked parts the mappings are split into
+MAPPING_SHARDS = 16
+# bump when the snapshot layout changes, older snapshots are ignored
+SNAPSHOT_VERSION = 4
+
+# mapping arrays hold 32 bit ints, which is enough for slots, msids and
+# telegram message ids. an array is only widened if a value doesn't fit
+INT_MIN, INT_MAX = -2**31, 2**31 - 1
+
+# returns `a` or, if `value` doesn't fit into it, a 64 bit copy of it
+def fit(a, value):
+	if a.typecode == 'i' and not INT_MIN <= value <= INT_MAX:
+		return array('q', a)
+	return a
+
+# Part of the mappings: the messages with msid % MAPPING_SHARDS == n and the
+# reverse index of the users with uid % MAPPING_SHARDS == n. Saving a mapping
+# and looking one up by message only take the lock of the message's shard,
+# looking one up by telegram id also the user's (one after the other).
+# Callers hold `lock`.
+class MappingShard():
 	def __init__(self):
-		self.lock = RLock()
-		self.counter = itertools.count()
-		self.msgs = {} # dict(msid -> CachedMessage)
-		self.idmap = {} # dict(uid -> dict(msid -> opaque))
-	def _saveMapping(self, x, uid, msid, data):
-		if uid not in x.keys():
-			x[uid] = {}
-		x[uid][msid] = data
-	def _lookupMapping(self, x, uid, msid, data):
-		if uid not in x.keys():
+		self.lock = InstrumentedLock()
+		# mappings are stored in sorted arrays of 32 bit ints instead of dicts
+		# and searched with bisect, users are referred to by a small slot
+		# number in the forward store
+		self.slots = {} # dict(uid -> slot)
+		self.idmap = {} # dict(msid -> array of n sorted slots followed by their n tg ids)
+		# stale reverse entries are skipped on lookup and pruned from the front
+		# on expiry. tg ids grow over time in every chat, so entries are
+		# (nearly) always added at the end and old ones are at the front
+		self.revmap = {} # dict(uid -> (array of sorted tg ids, array of msids))
+		self.mappings = 0 # total number of entries in idmap
+		self.hits = 0
+		self.misses = 0
+	def _getSlot(self, uid):
+		slot = self.slots.get(uid)
+		if slot is None:
+			slot = self.slots[uid] = len(self.slots)
+		return slot
+	# returns whether anything changed
+	def save(self, uid, msid, data):
+		if msid not in self.idmap.keys():
+			self.idmap[msid] = array('i')
+		a = self.idmap[msid] = fit(self.idmap[msid], data)
+		slot = self._getSlot(uid)
+		n = len(a) // 2
+		i = bisect_left(a, slot, 0, n)
+		if i < n and a[i] == slot:
+			if a[n + i] == data:
+				return False
+			a[n + i] = data # the old reverse entry goes stale
+		else:
+			a.insert(n + i, data)
+			a.insert(i, slot)
+			self.mappings += 1
+		return True
+	def saveReverse(self, uid, msid, data):
+		if uid not in self.revmap.keys():
+			self.revmap[uid] = (array('i'), array('i'))
+		values, msids = self.revmap[uid]
+		values, msids = self.revmap[uid] = (fit(values, data), fit(msids, msid))
+		i = bisect_right(values, data)
+		values.insert(i, data)
+		msids.insert(i, msid)
+	def lookup(self, uid, msid):
+		slot = self.slots.get(uid)
+		if msid not in self.idmap.keys() or slot is None:
 			return None
-		if msid is not None:
-			return x[uid].get(msid, None)
-		# data is not None
-		gen = ( msid for msid, _data in x[uid].items() if _data == data )
-		return next(gen, None)
+		a = self.idmap[msid]
+		n = len(a) // 2
+		i = bisect_left(a, slot, 0, n)
+		if i < n and a[i] == slot:
+			return a[n + i]
+		return None
+	# returns candidate msids, possibly stale
+	def lookupReverse(self, uid, data):
+		if uid not in self.revmap.keys():
+			return ()
+		values, msids = self.revmap[uid]
+		i = bisect_left(values, data)
+		j = bisect_right(values, data, i)
+		return msids[i:j]
+	def count(self, ret):
+		if ret is None:
+			self.misses += 1
+		else:
+			self.hits += 1
+	def delete(self, msid):
+		# only touches the forward store, reverse entries go stale
+		self.mappings -= len(self.idmap.pop(msid, ())) // 2
+	def pruneBefore(self, oldest):
+		# msids expire in order, so anything older than the oldest cached
+		# message is dead
+		for uid in list(self.revmap.keys()):
+			values, msids = self.revmap[uid]
+			n = 0
+			while n < len(msids) and (oldest is None or msids[n] < oldest):
+				n += 1
+			if n == len(msids):
+				del self.revmap[uid]
+			elif n > 0:
+				del values[:n]
+				del msids[:n]
+	def snapshot(self):
+		return {
+			"slots": dict(self.slots),
+			"idmap": {msid: (a.typecode, a.tobytes()) for msid, a in self.idmap.items()},
+			"revmap": {uid: (v.typecode, v.tobytes(), m.typecode, m.tobytes())
+				for uid, (v, m) in self.revmap.items()},
+		}
+	def restore(self, d):
+		self.slots = d["slots"]
+		for msid, (t, b) in d["idmap"].items():
+			self.idmap[msid] = array(t, b)
+			self.mappings += len(self.idmap[msid]) // 2
+		for uid, (tv, v, tm, m) in d["revmap"].items():
+			self.revmap[uid] = (array(tv, v), array(tm, m))
+
+class Cache():
+	shard_type = MappingShard
+	def __init__(self, settings=None):
+		settings = settings or {}
+		self.max_messages = settings.get("max_messages")
+		self.max_mappings = settings.get("max_mappings")
+		self.max_bytes = settings.get("max_bytes")
+		self.snapshot_path = settings.get("snapshot")
+		self.snapshot_interval = settings.get("snapshot_interval", 10)
+		# `lock` protects messages and the sender index, every shard has its
+		# own lock for its part of the mappings. lock order is `lock`, then a
+		# shard. no two shard locks are ever held at the same time
+		self.lock = InstrumentedLock()
+		self.counter = itertools.count()
+		self.last_msid = -1
+		self.msgs = {} # dict(msid -> CachedMessage), ordered by msid and thus by time
+		self.shards = list(self.shard_type() for _ in range(MAPPING_SHARDS))
+		self.senders = {} # dict(uid -> dict(msid -> None)), ordered by msid
+		self.evictions = 0
+		self.evicted = 0 # evictions since the reverse index was last pruned
+		self.on_evict = None # called with the msids of evicted messages
+		if self.snapshot_path is not None:
+			self._load()
+	def _shard(self, id):
+		return self.shards[id % len(self.shards)]
+	@property
+	def mappings(self):
+		return sum(shard.mappings for shard in self.shards)
+	def _deleteMappings(self, msids):
+		for msid in msids:
+			shard = self._shard(msid)
+			with shard.lock:
+				shard.delete(msid)
+	def _pruneReverse(self):
+		oldest = next(iter(self.msgs), None)
+		for shard in self.shards:
+			with shard.lock:
+				shard.pruneBefore(oldest)
+	def _deleteMessage(self, msid):
+		# delete message itself, from mappings and the sender index
+		cm = self.msgs.pop(msid)
+		self._deleteSender(cm.user_id, msid)
+		self._deleteMappings((msid, ))
+	def _estimateBytes(self):
+		return len(self.msgs) * MESSAGE_BYTES + self.mappings * MAPPING_BYTES
+	def _overLimit(self):
+		if self.max_messages is not None and len(self.msgs) > self.max_messages:
+			return True
+		if self.max_mappings is not None and self.mappings > self.max_mappings:
+			return True
+		if self.max_bytes is not None and self._estimateBytes() > self.max_bytes:
+			return True
+		return False
+	# returns the evicted msids
+	def _enforceLimits(self):
+		ids = []
+		# evict the oldest messages, but never the one currently being sent
+		while len(self.msgs) > 1 and self._overLimit():
+			msid = next(iter(self.msgs))
+			self._deleteMessage(msid)
+			ids.append(msid)
+			self.evictions += 1
+			self.evicted += 1
+		# pruning the reverse index is linear in the number of users,
+		# don't do it for every single eviction
+		if self.evicted >= EXPIRE_BATCH_SIZE:
+			self._pruneReverse()
+			self.evicted = 0
+		return ids
+	def _notifyEvicted(self, ids):
+		# called without holding any lock
+		if len(ids) > 0 and self.on_evict is not None:
+			self.on_evict(set(ids))
+	def _deleteSender(self, uid, msid):
+		d = self.senders.get(uid)
+		if d is None:
+			return
+		d.pop(msid, None)
+		if len(d) == 0:
+			del self.senders[uid]
 
 	def assignMessageId(self, cm: CachedMessage) -> int:
 		with self.lock:
-			ret = next(self.counter)
+			ret = self.last_msid = next(self.counter)
 			self.msgs[ret] = cm
+			if cm.user_id is not None:
+				self.senders.setdefault(cm.user_id, {})[ret] = None
+			evicted = self._enforceLimits()
+		self._notifyEvicted(evicted)
 		return ret
 	def getMessage(self, msid):
-		with self.lock:
-			return self.msgs.get(msid, None)
+		return self.msgs.get(msid, None) # single dict lookup, no lock needed
 	def iterateMessages(self, functor):
+		# iterate over a copy so that functor runs without holding the lock
 		with self.lock:
-			for msid, cm in self.msgs.items():
-				functor(msid, cm)
+			items = list(self.msgs.items())
+		for msid, cm in items:
+			functor(msid, cm)
 	def getMessages(self, uid):
 		with self.lock:
-			return {msid: msg for msid, msg in self.msgs.items() if msg.user_id == uid}
+			return {msid: self.msgs[msid] for msid in self.senders.get(uid, ())}
 	def saveMapping(self, uid, msid, data):
-		with self.lock:
-			self._saveMapping(self.idmap, uid, msid, data)
+		if msid is None:
+			return # not a cached message, e.g. a system message to one user
+		shard = self._shard(msid)
+		with shard.lock:
+			# messages are removed before their mappings (under the shard
+			# lock), so checking here without `lock` can't leave orphaned mappings
+			if msid not in self.msgs.keys():
+				return # expired while it was being delivered
+			changed = shard.save(uid, msid, data)
+		if changed:
+			# if the message expires in between, this entry is just stale
+			shard = self._shard(uid)
+			with shard.lock:
+				shard.saveReverse(uid, msid, data)
+		if self._overLimit():
+			with self.lock:
+				evicted = self._enforceLimits()
+			self._notifyEvicted(evicted)
 	def lookupMapping(self, uid, msid=None, data=None):
 		if msid is None and data is None:
 			raise ValueError()
-		with self.lock:
-			return self._lookupMapping(self.idmap, uid, msid, data)
+		if msid is not None:
+			shard = self._shard(msid)
+			with shard.lock:
+				ret = shard.lookup(uid, msid)
+				shard.count(ret)
+			return ret
+		# data is not None
+		shard = self._shard(uid)
+		with shard.lock:
+			candidates = shard.lookupReverse(uid, data) # a copy
+		ret = None
+		for msid in candidates:
+			# skip stale entries, the forward store has to agree
+			shard2 = self._shard(msid)
+			with shard2.lock:
+				if shard2.lookup(uid, msid) == data:
+					ret = msid
+					break
+		with shard.lock:
+			shard.count(ret)
+		return ret
 	def deleteMappings(self, msid):
+		self._deleteMappings((msid, ))
+	def _expireBatch(self, cutoff, ids):
+		batch = []
 		with self.lock:
-			for d in self.idmap.values():
-				d.pop(msid, None)
+			while len(batch) < EXPIRE_BATCH_SIZE:
+				msid = next(iter(self.msgs), None)
+				if msid is None or self.msgs[msid].time > cutoff:
+					break
+				cm = self.msgs.pop(msid)
+				self._deleteSender(cm.user_id, msid)
+				batch.append(msid)
+		# the messages are gone, so no new mappings can be saved for them
+		self._deleteMappings(batch)
+		ids.update(batch)
+		return len(batch) == EXPIRE_BATCH_SIZE
 	def expire(self):
 		ids = set()
-		with self.lock:
-			for msid in list(self.msgs.keys()):
-				if not self.msgs[msid].isExpired():
-					continue
-				ids.add(msid)
-				# delete message itself and from mappings
-				del self.msgs[msid]
-				self.deleteMappings(msid)
+		cutoff = datetime.now() - CACHE_DURATION
+		# messages are in insertion order, so stop at the first live one
+		while self._expireBatch(cutoff, ids):
+			pass
+		if len(ids) > 0:
+			with self.lock:
+				self._pruneReverse()
 		if len(ids) > 0:
 			logging.debug("Expired %d entries from cache", len(ids))
 		return ids
+	def getStats(self):
+		with self.lock:
+			return {
+				"Cache mappings": self.mappings,
+				"Cache size (est.)": "%d KiB" % (self._estimateBytes() // 1024),
+				"Cache evictions": self.evictions,
+				"Cache hits/misses": "%d/%d" % (sum(shard.hits for shard in self.shards),
+					sum(shard.misses for shard in self.shards)),
+				"Cache message lock": self.lock.format(),
+				"Cache mapping locks": InstrumentedLock.total(shard.lock for shard in self.shards).format(),
+			}
+	# snapshots only contain plain data so they don't depend on class layout
+	def _snapshot(self):
+		msgs = list(
+			(msid, cm.user_id, cm.time, cm.warned, set(cm.upvoted), set(cm.downvoted))
+			for msid, cm in self.msgs.items()
+		)
+		return {
+			"version": SNAPSHOT_VERSION,
+			"last_msid": self.last_msid,
+			"msgs": msgs,
+			"shards": list(self._snapshotShard(shard) for shard in self.shards),
+		}
+	def _snapshotShard(self, shard):
+		with shard.lock:
+			return shard.snapshot()
+	def _restore(self, d):
+		self.last_msid = d["last_msid"]
+		self.counter = itertools.count(self.last_msid + 1)
+		for msid, user_id, time, warned, upvoted, downvoted in d["msgs"]:
+			cm = CachedMessage(user_id)
+			cm.time, cm.warned = time, warned
+			cm.upvoted, cm.downvoted = upvoted, downvoted
+			self.msgs[msid] = cm
+			if user_id is not None:
+				self.senders.setdefault(user_id, {})[msid] = None
+		for shard, d2 in zip(self.shards, d["shards"]):
+			shard.restore(d2)
+	def _load(self):
+		try:
+			with open(self.snapshot_path, "rb") as f:
+				d = pickle.load(f)
+		except FileNotFoundError:
+			return
+		except Exception as e:
+			logging.warning("Failed to load cache snapshot: %s", e)
+			return
+		if d.get("version") != SNAPSHOT_VERSION or len(d["shards"]) != len(self.shards):
+			logging.warning("Ignoring cache snapshot with unknown version")
+			return
+		with self.lock:
+			self._restore(d)
+		self.expire()
+		logging.info("Loaded %d messages from cache snapshot", len(self.msgs))
+	def save(self):
+		if self.snapshot_path is None:
+			return
+		# only copying happens under the lock, serializing and writing don't
+		with self.lock:
+			d = self._snapshot()
+		with open(self.snapshot_path + "~", "wb") as f:
+			pickle.dump(d, f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(self.snapshot_path + "~", self.snapshot_path)
+	def register_tasks(self, sched):
+		if self.snapshot_path is None:
+			return
+		sched.register(self.save, minutes=self.snapshot_interval)
+	def close(self):
+		self.save()
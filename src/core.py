@@ -92,12 +92,9 @@ def register_tasks(sched):
 	# warning removal
 	def task():
 		now = datetime.now()
-		for user in db.iterateUsers():
-			if not user.isJoined():
-				continue
-			if user.warnExpiry is not None and now >= user.warnExpiry:
-				with db.modifyUser(id=user.id) as user:
-					user.removeWarning()
+		for user in db.iterateExpiredWarnings(now):
+			with db.modifyUser(id=user.id) as user:
+				user.removeWarning()
 	sched.register(task, minutes=15)
 
 def updateUserFromEvent(user, c_user):
@@ -106,31 +103,15 @@ def updateUserFromEvent(user, c_user):
 	user.lastActive = datetime.now()
 
 def getUserByName(username):
-	username = username.lower()
 	# there *should* only be a single joined user with a given username
-	for user in db.iterateUsers():
-		if not user.isJoined():
-			continue
-		if user.username is not None and user.username.lower() == username:
-			return user
-	return None
+	return db.getUserByUsername(username)
 
 def getUserByOid(oid):
-	for user in db.iterateUsers():
-		if not user.isJoined():
-			continue
-		if user.getObfuscatedId() == oid:
-			return user
-	return None
+	return db.getUserByOid(oid)
 
 def getRecentlyActiveUsers():
-	users = db.iterateUsers()
 	cache_start_datetime = max(launched, datetime.now() - timedelta(hours=24))
-	count = 0
-	for user in users:
-		if (user.lastActive is not None) and (user.lastActive > cache_start_datetime):
-			count += 1
-	return count
+	return db.countRecentlyActiveUsers(cache_start_datetime)
 
 def getKarmaLevel(karma):
 	karma_level = 0
@@ -156,8 +137,9 @@ def requireUser(func):
 				return rp.Reply(rp.types.USER_NOT_IN_CHAT, bot_name=bot_name)
 
 		# keep db entry up to date with current usernames and last activity
-		with db.modifyUser(id=user.id) as user:
-			updateUserFromEvent(user, c_user)
+		# (the write is batched by the db)
+		updateUserFromEvent(user, c_user)
+		db.updateActivity(user)
 
 		# check for blacklist or absence
 		if user.isBlacklisted():
@@ -491,7 +473,7 @@ def get_karma_info(user):
 
 @requireUser
 @requireRank(RANKS.admin)
-def get_bot_info(user):
+def get_bot_info(user, stats=None):
 	params = {
 		"python_ver": sys.version,
 		"os": sys.platform,
@@ -505,22 +487,16 @@ def get_bot_info(user):
 		"launched": launched,
 		"time": format_datetime(datetime.now(), True),
 		"cached_msgs": len(ch.msgs),
-		"active_users": getRecentlyActiveUsers()
+		"active_users": getRecentlyActiveUsers(),
+		"stats": stats or {},
 	}
 	return rp.Reply(rp.types.BOT_INFO, **params)
 
 @requireUser
 def get_users(user):
-	active, inactive, black, cooldown = 0, 0, 0, 0
-	for user2 in db.iterateUsers():
-		if user2.isBlacklisted():
-			black += 1
-		elif not user2.isJoined():
-			inactive += 1
-		else:
-			active += 1
-		if user2.isInCooldown():
-			cooldown += 1
+	counts = db.countUsers()
+	active, inactive = counts["active"], counts["inactive"]
+	black, cooldown = counts["blacklisted"], counts["cooldown"]
 	if user.rank < RANKS.mod:
 		return rp.Reply(rp.types.USERS_INFO,
         	active=active, inactive=inactive + black, total=active + inactive + black)
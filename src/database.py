@@ -1,7 +1,10 @@
 import logging
 import os
 import json
+import queue
 import sqlite3
+import urllib.request
+from contextlib import contextmanager
 from datetime import date, datetime, timedelta, timezone
 from random import randint
 from threading import RLock
@@ -26,9 +29,67 @@ USER_PROPS = (
 	"hideKarma", "debugEnabled", "tripcode"
 )
 
+# Obfuscated ids are derived from the user id and a salt that changes daily.
+# This caches them in both directions for the current salt, the reverse map is
+# built on first use after the salt changed and patched when users are added.
+
+class ObfuscatedIdTable():
+	def __init__(self):
+		self.lock = RLock()
+		self.day = None
+		self.salt = None
+		self.oids = {} # uid -> oid
+		self.uids = {} # oid -> list of uids
+		self.complete = False # does `uids` cover all users?
+	def _rollover(self):
+		day = date.today().toordinal()
+		if day == self.day:
+			return
+		self.day = self.salt = day
+		if self.salt & 0xff == 0: self.salt >>= 8 # zero bits are bad for hashing
+		self.oids.clear()
+		self.uids.clear()
+		self.complete = False
+	def _add(self, uid):
+		value = (uid * self.salt) & 0xffffff
+		alpha = "0123456789abcdefghijklmnopqrstuv"
+		oid = ''.join(alpha[n%32] for n in (value, value>>5, value>>10, value>>15))
+		self.oids[uid] = oid
+		self.uids.setdefault(oid, []).append(uid)
+		return oid
+	def get(self, uid):
+		with self.lock:
+			self._rollover()
+			oid = self.oids.get(uid)
+			return oid if oid is not None else self._add(uid)
+	def add(self, uid):
+		self.get(uid)
+	# return ids of users with the obfuscated id `oid`, `iterate_ids` is used
+	# to fetch all user ids if the table isn't complete yet
+	def lookup(self, oid, iterate_ids):
+		with self.lock:
+			self._rollover()
+			complete = self.complete
+		if not complete:
+			ids = list(iterate_ids())
+			with self.lock:
+				self._rollover()
+				for uid in ids:
+					if uid not in self.oids:
+						self._add(uid)
+				self.complete = True
+		with self.lock:
+			return list(self.uids.get(oid, ()))
+
+obfuscated_ids = ObfuscatedIdTable()
+
+# props that are updated whenever a user interacts with the bot
+ACTIVITY_PROPS = ("username", "realname", "lastActive")
+
 class User():
-	__slots__ = USER_PROPS
+	__slots__ = USER_PROPS + ("_dirty", )
 	def __init__(self):
+		object.__setattr__(self, "_dirty", set()) # props changed since last write
 		self.id = None # int
 		self.username = None # str?
 		self.chat_username = None # str
@@ -48,12 +109,36 @@ class User():
 		self.hideKarma = None # bool
 		self.debugEnabled = None # bool
 		self.tripcode = None # str?
+		self._dirty.clear()
+	def __setattr__(self, name, value):
+		try:
+			changed = getattr(self, name) != value
+		except AttributeError:
+			changed = True
+		if changed:
+			self._dirty.add(name)
+		object.__setattr__(self, name, value)
 	def __eq__(self, other):
 		if isinstance(other, User):
 			return self.id == other.id
 		return NotImplemented
 	def __str__(self):
 		return "<User id=%d aka %r>" % (self.id, self.getFormattedName())
+	def copy(self):
+		user = User()
+		for prop in USER_PROPS:
+			setattr(user, prop, getattr(self, prop))
+		user.markClean()
+		return user
+	def isDirty(self):
+		return len(self._dirty) > 0
+	def getDirty(self):
+		return set(self._dirty)
+	def markClean(self, *props):
+		if len(props) == 0:
+			self._dirty.clear()
+		else:
+			self._dirty.difference_update(props)
 	def defaults(self):
 		self.rank = RANKS.user
 		self.joined = datetime.now()
@@ -70,11 +155,7 @@ class User():
 	def isBlacklisted(self):
 		return self.rank < 0
 	def getObfuscatedId(self):
-		salt = date.today().toordinal()
-		if salt & 0xff == 0: salt >>= 8 # zero bits are bad for hashing
-		value = (self.id * salt) & 0xffffff
-		alpha = "0123456789abcdefghijklmnopqrstuv"
-		return ''.join(alpha[n%32] for n in (value, value>>5, value>>10, value>>15))
+		return obfuscated_ids.get(self.id)
 	def getObfuscatedKarma(self):
 		offset = round(abs(self.karma * 0.2) + 2)
 		return self.karma + randint(0, offset + 1) - offset
@@ -136,7 +217,13 @@ class ModificationContext():
 class Database():
 	def __init__(self):
 		self.lock = RLock()
+		self.observers = [] # functions called with every user written to the db
 		assert self.__class__ != Database # do not instantiate directly
+	def observe(self, func):
+		self.observers.append(func)
+	def _notify(self, user):
+		for func in self.observers:
+			func(user)
 	def register_tasks(self, sched):
 		raise NotImplementedError()
 	def close(self):
@@ -157,6 +244,51 @@ class Database():
 		with self.lock:
 			l = list(self.getUser(id=id) for id in self.iterateUserIds())
 		yield from l
+	# the following queries can be overridden by backends that do better than
+	# looking at every user
+	# return the joined user with the given username (case-insensitive) or None
+	def getUserByUsername(self, username):
+		username = username.lower()
+		for user in self.iterateUsers():
+			if user.isJoined() and user.username is not None and user.username.lower() == username:
+				return user
+		return None
+	# return the joined user with the obfuscated id `oid` or None
+	def getUserByOid(self, oid):
+		for id in obfuscated_ids.lookup(oid, self.iterateUserIds):
+			user = self.getUser(id=id)
+			if user.isJoined():
+				return user
+		return None
+	# return number of active, inactive, blacklisted users and users in cooldown
+	def countUsers(self):
+		d = {"active": 0, "inactive": 0, "blacklisted": 0, "cooldown": 0}
+		for user in self.iterateUsers():
+			if user.isBlacklisted():
+				d["blacklisted"] += 1
+			elif not user.isJoined():
+				d["inactive"] += 1
+			else:
+				d["active"] += 1
+			if user.isInCooldown():
+				d["cooldown"] += 1
+		return d
+	def count_active_users(self):
+		return sum(1 for user in self.iterateUsers() if user.isJoined())
+	def countRecentlyActiveUsers(self, since):
+		return sum(1 for user in self.iterateUsers()
+			if user.lastActive is not None and user.lastActive > since)
+	# return joined users whose warnings have expired at `now`
+	def iterateExpiredWarnings(self, now):
+		for user in self.iterateUsers():
+			if user.isJoined() and user.warnExpiry is not None and now >= user.warnExpiry:
+				yield user
+	# store the activity props of `user`, backends may defer the actual write
+	def updateActivity(self, user):
+		with self.modifyUser(id=user.id) as u:
+			for prop in ACTIVITY_PROPS:
+				setattr(u, prop, getattr(user, prop))
+		user.markClean(*ACTIVITY_PROPS)
 	def modifyUser(self, **kwargs):
 		with self.lock:
 			user = self.getUser(**kwargs)
@@ -228,6 +360,7 @@ class JSONDatabase(Database):
 		for prop in dateprops:
 			if d[prop] is not None:
 				setattr(user, prop, datetime.utcfromtimestamp(d[prop]))
+		user.markClean()
 		return user
 	def _load(self):
 		with self.lock:
@@ -248,18 +381,25 @@ class JSONDatabase(Database):
 			except StopIteration as e:
 				raise KeyError()
 	def setUser(self, id, newuser):
-		newuser = JSONDatabase._userToDict(newuser)
+		if not newuser.isDirty():
+			return
+		d = JSONDatabase._userToDict(newuser)
 		with self.lock:
 			for i, user in enumerate(self.db["users"]):
 				if user["id"] == id:
-					self.db["users"][i] = newuser
+					self.db["users"][i] = d
 					self._save()
+					newuser.markClean()
+					self._notify(newuser)
 					return
 	def addUser(self, newuser):
-		newuser = JSONDatabase._userToDict(newuser)
+		d = JSONDatabase._userToDict(newuser)
 		with self.lock:
-			self.db["users"].append(newuser)
+			self.db["users"].append(d)
 			self._save()
+			obfuscated_ids.add(newuser.id)
+			newuser.markClean()
+			self._notify(newuser)
 	def iterateUserIds(self):
 		with self.lock:
 			l = list(u["id"] for u in self.db["users"])
@@ -275,22 +415,97 @@ class JSONDatabase(Database):
 
 # SQLite implementation
 
+# `profile` tunes the storage, supported keys:
+# journal_mode, synchronous: passed to the PRAGMAs of the same name
+# mmap_size, cache_size: same (integers)
+# read_connections: number of read-only connections for reads to use
+#   instead of waiting for the lock (WAL mode only)
 class SQLiteDatabase(Database):
-	def __init__(self, path):
+	def __init__(self, path, profile=None):
 		super(SQLiteDatabase, self).__init__()
-		self.db = sqlite3.connect(path, check_same_thread=False,
-			detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
-		self.db.row_factory = sqlite3.Row
+		profile = profile or {}
+		self.db = SQLiteDatabase._connect(path, profile)
+		self.activity = {} # uid -> values of ACTIVITY_PROPS not yet written
 		self._ensure_schema()
+		self.db.commit()
+		# in WAL mode a commit doesn't block readers and with synchronous=NORMAL
+		# is cheap, so commit right away and let other connections see writes
+		wal = self.db.execute("PRAGMA journal_mode").fetchone()[0].lower() == "wal"
+		self.commit_writes = wal
+		self.readers = None
+		n = int(profile.get("read_connections", 0))
+		if n > 0 and not wal:
+			logging.warning("Read connections need journal_mode: wal, ignoring.")
+		elif n > 0 and path != ":memory:":
+			self.readers = queue.Queue()
+			uri = "file:%s?mode=ro" % urllib.request.pathname2url(os.path.abspath(path))
+			for _ in range(n):
+				self.readers.put(SQLiteDatabase._connect(uri, profile, uri=True))
+	@staticmethod
+	def _connect(path, profile, uri=False):
+		conn = sqlite3.connect(path, check_same_thread=False, uri=uri,
+			detect_types=sqlite3.PARSE_DECLTYPES|sqlite3.PARSE_COLNAMES)
+		conn.row_factory = sqlite3.Row
+		for k in ("journal_mode", "synchronous"):
+			if k in profile and not uri:
+				if not str(profile[k]).isalpha():
+					raise ValueError("Invalid value for %s" % k)
+				conn.execute("PRAGMA %s = %s" % (k, profile[k]))
+		for k in ("mmap_size", "cache_size"):
+			if k in profile:
+				conn.execute("PRAGMA %s = %d" % (k, int(profile[k])))
+		return conn
+	# connection to run a read query on
+	@contextmanager
+	def _reader(self):
+		if self.readers is None:
+			with self.lock:
+				yield self.db
+			return
+		conn = self.readers.get()
+		try:
+			yield conn
+		finally:
+			self.readers.put(conn)
+	def _written(self):
+		if self.commit_writes:
+			self.db.commit()
+	# make sure buffered activity is visible to queries
+	def _syncActivity(self):
+		with self.lock:
+			if len(self.activity) > 0:
+				self._flushActivity()
+				self._written()
 	def register_tasks(self, sched):
 		def f():
 			with self.lock:
+				self._flushActivity()
 				self.db.commit()
 		sched.register(f, seconds=5)
 	def close(self):
 		with self.lock:
+			self._flushActivity()
 			self.db.commit()
 			self.db.close()
+		while self.readers is not None and not self.readers.empty():
+			self.readers.get().close()
+	def _flushActivity(self):
+		if len(self.activity) == 0:
+			return
+		sql = "UPDATE users SET "
+		sql += ", ".join("`%s` = ?" % k for k in ACTIVITY_PROPS)
+		sql += " WHERE id = ?"
+		param = list(v + (id, ) for id, v in self.activity.items())
+		self.db.executemany(sql, param)
+		self.activity.clear()
+	# apply activity that hasn't been written yet to `user`
+	def _applyActivity(self, user):
+		v = self.activity.get(user.id)
+		if v is None:
+			return
+		for prop, value in zip(ACTIVITY_PROPS, v):
+			setattr(user, prop, value)
+		user.markClean(*ACTIVITY_PROPS)
 	@staticmethod
 	def _systemConfigToDict(config):
 		return {"motd": config.motd}
@@ -308,6 +523,7 @@ class SQLiteDatabase(Database):
 		user = User()
 		for prop in r.keys():
 			setattr(user, prop, r[prop])
+		user.markClean()
 		return user
 	
 
@@ -361,52 +577,83 @@ CREATE TABLE IF NOT EXISTS `users` (
 				self.db.execute("ALTER TABLE `users` ADD `media_count` INTEGER NOT NULL DEFAULT 0")
 			if not row_exists("users", "last_media"):
 				self.db.execute("ALTER TABLE `users` ADD `last_media` TIMESTAMP")
+			# indexes
+			self.db.execute("CREATE INDEX IF NOT EXISTS `users_username` ON `users` (lower(`username`))")
+			for name in ("left", "rank", "warnExpiry", "lastActive"):
+				self.db.execute("CREATE INDEX IF NOT EXISTS `users_%s` ON `users` (`%s`)" % (name, name))
 	def getUser(self, id=None):
 		if id is None:
 			raise ValueError()
 		sql = "SELECT * FROM users WHERE id = ?"
 		param = id
-		with self.lock:
-			cur = self.db.execute(sql, (param, ))
+		with self._reader() as conn:
+			cur = conn.execute(sql, (param, ))
 			row = cur.fetchone()
 		if row is None:
 			raise KeyError()
-		return SQLiteDatabase._userFromRow(row)
+		user = SQLiteDatabase._userFromRow(row)
+		with self.lock:
+			self._applyActivity(user)
+		return user
 	def setUser(self, id, newuser):
-		newuser = SQLiteDatabase._userToDict(newuser)
-		del newuser['id'] # this is our primary key
+		# only write the columns that were actually changed
+		props = [prop for prop in USER_PROPS if prop in newuser.getDirty()]
+		if 'id' in props:
+			props.remove('id') # this is our primary key
+		if len(props) == 0:
+			return
 		sql = "UPDATE users SET "
-		sql += ", ".join("`%s` = ?" % k for k in newuser.keys())
+		sql += ", ".join("`%s` = ?" % k for k in props)
 		sql += " WHERE id = ?"
-		param = list(newuser.values()) + [id, ]
+		param = [getattr(newuser, k) for k in props] + [id, ]
 		with self.lock:
 			self.db.execute(sql, param)
+			# don't let pending activity overwrite what was just written
+			v = self.activity.get(id)
+			if v is not None:
+				self.activity[id] = tuple(getattr(newuser, prop) if prop in props else value
+					for prop, value in zip(ACTIVITY_PROPS, v))
+			self._written()
+			newuser.markClean()
+			self._notify(newuser)
+	def updateActivity(self, user):
+		with self.lock:
+			self.activity[user.id] = tuple(getattr(user, prop) for prop in ACTIVITY_PROPS)
+			user.markClean(*ACTIVITY_PROPS)
+			self._notify(user)
 	def addUser(self, newuser):
-		newuser = SQLiteDatabase._userToDict(newuser)
+		d = SQLiteDatabase._userToDict(newuser)
 		sql = "INSERT INTO users("
-		sql += ", ".join("`%s`" % k for k in newuser.keys())
+		sql += ", ".join("`%s`" % k for k in d.keys())
 		sql += ") VALUES ("
-		sql += ", ".join("?" for i in range(len(newuser)))
+		sql += ", ".join("?" for i in range(len(d)))
 		sql += ")"
-		param = list(newuser.values())
+		param = list(d.values())
 		with self.lock:
 			self.db.execute(sql, param)
+			self._written()
+			obfuscated_ids.add(newuser.id)
+			newuser.markClean()
+			self._notify(newuser)
 	def iterateUserIds(self):
 		sql = "SELECT `id` FROM users"
-		with self.lock:
-			cur = self.db.execute(sql)
-			l = cur.fetchall()
+		with self._reader() as conn:
+			cur = conn.execute(sql)
+			l = list(row[0] for row in cur)
 		yield from l
 	def iterateUsers(self):
 		sql = "SELECT * FROM users"
-		with self.lock:
-			cur = self.db.execute(sql)
+		with self._reader() as conn:
+			cur = conn.execute(sql)
 			l = list(SQLiteDatabase._userFromRow(row) for row in cur)
+		with self.lock:
+			for user in l:
+				self._applyActivity(user)
 		yield from l
 	def getSystemConfig(self):
 		sql = "SELECT * FROM system_config"
-		with self.lock:
-			cur = self.db.execute(sql)
+		with self._reader() as conn:
+			cur = conn.execute(sql)
 			d = {row['name']: row['value'] for row in cur}
 		return SQLiteDatabase._systemConfigFromDict(d)
 	def setSystemConfig(self, config):
@@ -415,9 +662,130 @@ CREATE TABLE IF NOT EXISTS `users` (
 		with self.lock:
 			for k, v in d.items():
 				self.db.execute(sql, (k, v))
+			self._written()
 	# return count of users where joined is not null and left is null
 	def count_active_users(self):
 		sql = "SELECT COUNT(*) FROM users WHERE joined IS NOT NULL AND left IS NULL"
+		with self._reader() as conn:
+			cur = conn.execute(sql)
+			return cur.fetchone()[0]
+	def _queryUsers(self, sql, param=()):
+		with self._reader() as conn:
+			cur = conn.execute(sql, param)
+			l = list(SQLiteDatabase._userFromRow(row) for row in cur)
 		with self.lock:
-			cur = self.db.execute(sql)
+			for user in l:
+				self._applyActivity(user)
+		return l
+	def getUserByUsername(self, username):
+		self._syncActivity()
+		sql = "SELECT * FROM users WHERE lower(`username`) = ? AND `left` IS NULL LIMIT 1"
+		l = self._queryUsers(sql, (username.lower(), ))
+		return l[0] if len(l) > 0 else None
+	def countUsers(self):
+		sql = "SELECT SUM(`rank` < 0), SUM(`rank` >= 0 AND `left` IS NOT NULL), "
+		sql += "SUM(`rank` >= 0 AND `left` IS NULL), SUM(`cooldownUntil` >= ?) FROM users"
+		with self._reader() as conn:
+			cur = conn.execute(sql, (datetime.now(), ))
+			row = cur.fetchone()
+		keys = ("blacklisted", "inactive", "active", "cooldown")
+		return {k: v or 0 for k, v in zip(keys, row)}
+	def countRecentlyActiveUsers(self, since):
+		self._syncActivity()
+		sql = "SELECT COUNT(*) FROM users WHERE `lastActive` > ?"
+		with self._reader() as conn:
+			cur = conn.execute(sql, (since, ))
 			return cur.fetchone()[0]
+	def iterateExpiredWarnings(self, now):
+		sql = "SELECT * FROM users WHERE `warnExpiry` <= ? AND `left` IS NULL"
+		yield from self._queryUsers(sql, (now, ))
+
+# Write-through user cache in front of another database
+
+class CachedDatabase(Database):
+	def __init__(self, backend):
+		super(CachedDatabase, self).__init__()
+		self.backend = backend
+		self.users = {user.id: user for user in backend.iterateUsers()} # uid -> User
+		self.all = tuple(self.users.values())
+	def __getattr__(self, name):
+		# pass through backend-specific methods
+		return getattr(self.backend, name)
+	def register_tasks(self, sched):
+		self.backend.register_tasks(sched)
+		sched.register(self.refresh, minutes=1)
+	def close(self):
+		self.backend.close()
+	# pick up changes other processes (util/blacklist.py, util/perms.py) made
+	# to the database. activity is left alone, ours is newer
+	def refresh(self):
+		# writes go through while holding the lock, so what's read here
+		# can't be older than the residents
+		with self.lock:
+			for user in self.backend.iterateUsers():
+				resident = self.users.get(user.id)
+				if resident is None:
+					self.users[user.id] = user
+					self.all = tuple(self.users.values())
+					self._notify(user)
+					continue
+				props = list(prop for prop in USER_PROPS if prop not in ACTIVITY_PROPS
+					and getattr(resident, prop) != getattr(user, prop))
+				if len(props) == 0:
+					continue
+				for prop in props:
+					setattr(resident, prop, getattr(user, prop))
+				resident.markClean(*props)
+				self._notify(resident)
+	def getUser(self, id=None):
+		if id is None:
+			raise ValueError()
+		with self.lock:
+			return self.users[id]
+	def setUser(self, id, newuser):
+		with self.lock:
+			props = newuser.getDirty()
+			if len(props) == 0:
+				return
+			self.backend.setUser(id, newuser)
+			user = self.users.get(id)
+			if user is None:
+				return
+			if user is not newuser:
+				for prop in props:
+					setattr(user, prop, getattr(newuser, prop))
+				user.markClean()
+			self._notify(user)
+	def addUser(self, newuser):
+		with self.lock:
+			self.backend.addUser(newuser)
+			self.users[newuser.id] = newuser
+			self.all = tuple(self.users.values())
+			self._notify(newuser)
+	def updateActivity(self, user):
+		with self.lock:
+			resident = self.users.get(user.id)
+			if resident is None:
+				return
+			if resident is not user:
+				for prop in ACTIVITY_PROPS:
+					setattr(resident, prop, getattr(user, prop))
+				resident.markClean(*ACTIVITY_PROPS)
+			self.backend.updateActivity(user)
+			self._notify(resident)
+	def iterateUserIds(self):
+		with self.lock:
+			l = list(self.users.keys())
+		yield from l
+	def iterateUsers(self):
+		yield from self.all
+	def modifyUser(self, **kwargs):
+		with self.lock:
+			user = self.getUser(**kwargs)
+			# hand out a copy so that changes are only applied on success
+			callback = lambda newuser: self.setUser(user.id, newuser)
+			return ModificationContext(user.copy(), callback, self.lock)
+	def getSystemConfig(self):
+		return self.backend.getSystemConfig()
+	def setSystemConfig(self, config):
+		self.backend.setSystemConfig(config)
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+import threading
+
+import telebot
+
+from src.util import RetryAfter
+
+try:
+	import httpx
+except ImportError:
+	httpx = None
+
+API_URL = "https://api.telegram.org/bot{0}/{1}"
+
+# Bot API call that the async backend can perform by itself instead of
+# running a queue item's (blocking) function
+class ApiCall():
+	__slots__ = ("build", "on_result", "on_error")
+	def __init__(self, build, on_result=None, on_error=None):
+		self.build = build # returns (method, params) or None if unsupported
+		self.on_result = on_result # called with the decoded "result" field
+		self.on_error = on_error # called with an ApiException, returns whether to retry
+
+# Delivers queue items over a pooled HTTP connection from an asyncio loop
+# running in its own thread, with up to `concurrency` requests in flight.
+# Items without an ApiCall are run in a thread pool as before.
+class AsyncDelivery():
+	def __init__(self, token, concurrency=100, http2=False):
+		self.token = token
+		self.slots = threading.Semaphore(concurrency)
+		self.loop = asyncio.new_event_loop()
+		limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+		timeout = httpx.Timeout(30.0)
+		try:
+			self.client = httpx.AsyncClient(http2=http2, limits=limits, timeout=timeout)
+		except ImportError:
+			logging.warning("HTTP/2 support is not installed, using HTTP/1.1")
+			self.client = httpx.AsyncClient(limits=limits, timeout=timeout)
+	@staticmethod
+	def available():
+		return httpx is not None
+	def run(self):
+		asyncio.set_event_loop(self.loop)
+		self.loop.run_forever()
+	# hand `item` to the event loop, blocks while too many requests are in
+	# flight. `on_done(item)` is called from the loop once it's finished, or
+	# `on_retry(item, seconds)` if Telegram asked us to try again later
+	def submit(self, item, on_done, on_retry):
+		self.slots.acquire()
+		asyncio.run_coroutine_threadsafe(self._run(item, on_done, on_retry), self.loop)
+	async def _request(self, method, params):
+		r = await self.client.post(API_URL.format(self.token, method), json=params)
+		try:
+			d = r.json()
+		except ValueError:
+			raise telebot.apihelper.ApiException("HTTP %d" % r.status_code, method, r)
+		if not d.get("ok"):
+			# same exception the synchronous backend raises, so that errors
+			# can be handled by the same code
+			raise telebot.apihelper.ApiTelegramException(method, r, d)
+		return d["result"]
+	async def _perform(self, call, req):
+		while True:
+			try:
+				result = await self._request(*req)
+			except telebot.apihelper.ApiException as e:
+				if call.on_error is None:
+					return
+				# error handling may block, keep it off the event loop
+				retry = await self.loop.run_in_executor(None, call.on_error, e)
+				if retry:
+					continue
+				return
+			except httpx.HTTPError as e:
+				logging.warning("%s while calling %s", type(e).__name__, req[0])
+				return
+			if call.on_result is not None:
+				call.on_result(result)
+			return
+	async def _run(self, item, on_done, on_retry):
+		retry_after = None
+		try:
+			call = item.api_call
+			req = None if call is None else call.build()
+			if req is None:
+				await self.loop.run_in_executor(None, item.call)
+			else:
+				await self._perform(call, req)
+		except RetryAfter as e:
+			retry_after = e.seconds
+		except Exception as e:
+			logging.exception("Exception raised during queued message")
+		finally:
+			self.slots.release()
+		if retry_after is not None:
+			on_retry(item, retry_after)
+		else:
+			on_done(item)
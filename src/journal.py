@@ -0,0 +1,122 @@
+import logging
+import itertools
+import json
+import sqlite3
+from threading import RLock
+
+# Journal of pending deliveries, so that a restart doesn't drop the rest of a
+# fan-out. Records are written in batches from a scheduled task (no fsync per
+# message, the database runs in WAL mode with synchronous=NORMAL) and deleted
+# once acknowledged. Payloads are stored once and shared by all recipients.
+class DeliveryJournal():
+	def __init__(self, path):
+		# `lock` protects the buffers and is never held during I/O: record()
+		# runs for every recipient and ack() under the send queue's lock.
+		# `io_lock` serializes use of the database
+		self.lock = RLock()
+		self.io_lock = RLock()
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.execute("PRAGMA journal_mode = WAL")
+		self.db.execute("PRAGMA synchronous = NORMAL")
+		self.db.execute("""
+CREATE TABLE IF NOT EXISTS `payloads` (
+	`id` INTEGER NOT NULL,
+	`data` TEXT NOT NULL,
+	PRIMARY KEY (`id`)
+);
+		""".strip())
+		self.db.execute("""
+CREATE TABLE IF NOT EXISTS `deliveries` (
+	`id` INTEGER NOT NULL,
+	`payload` INTEGER NOT NULL,
+	`user_id` BIGINT NOT NULL,
+	`msid` INTEGER,
+	`reply_to` BIGINT,
+	PRIMARY KEY (`id`)
+);
+		""".strip())
+		self.db.commit()
+		# ids are handed out here so records can be acknowledged before they
+		# have been written
+		def next_id(table):
+			row = self.db.execute("SELECT MAX(`id`) FROM `%s`" % table).fetchone()
+			return itertools.count((row[0] or 0) + 1)
+		self.record_ids = next_id("deliveries")
+		self.payload_ids = next_id("payloads")
+		self.payloads = [] # (id, data) not yet written
+		self.records = {} # maps id -> row not yet written
+		self.acks = [] # ids of written records to delete
+		self.last_payload = None # (key, id) of the latest payload
+	# add a delivery of the payload returned by `encode()` to `user_id`,
+	# `key` identifies the payload so that it's only stored once when
+	# recipients of the same message are recorded one after another (None if
+	# it can't be shared)
+	def record(self, user_id, msid, reply_to, key, encode):
+		with self.lock:
+			if key is not None and self.last_payload is not None and self.last_payload[0] == key:
+				pid = self.last_payload[1]
+			else:
+				pid = next(self.payload_ids)
+				self.payloads.append((pid, json.dumps(encode())))
+				self.last_payload = (key, pid)
+			rid = next(self.record_ids)
+			self.records[rid] = (rid, pid, user_id, msid, reply_to)
+			return rid
+	def ack(self, rid):
+		with self.lock:
+			if self.records.pop(rid, None) is None:
+				self.acks.append(rid)
+	# hands out the buffers and starts new ones, caller holds `lock`
+	def _take(self):
+		ret = (self.payloads, list(self.records.values()), self.acks)
+		self.payloads = []
+		self.records = {}
+		self.acks = []
+		return ret
+	# caller holds `io_lock`
+	def _write(self, payloads, records, acks):
+		if len(payloads) + len(records) + len(acks) == 0:
+			return
+		self.db.executemany("INSERT INTO `payloads` VALUES (?, ?)", payloads)
+		self.db.executemany("INSERT INTO `deliveries` VALUES (?, ?, ?, ?, ?)", records)
+		# records acknowledged while this runs end up in the next batch
+		self.db.executemany("DELETE FROM `deliveries` WHERE `id` = ?", ((rid, ) for rid in acks))
+		self.db.commit()
+	def flush(self):
+		with self.io_lock:
+			with self.lock:
+				batch = self._take()
+			self._write(*batch)
+	def _collect(self):
+		with self.io_lock:
+			with self.lock:
+				# the latest payload might be deleted below, later records get
+				# a new one
+				self.last_payload = None
+				batch = self._take()
+			self._write(*batch)
+			self.db.execute("DELETE FROM `payloads` WHERE `id` NOT IN (SELECT `payload` FROM `deliveries`)")
+			self.db.commit()
+	# returns list of (id, user_id, msid, reply_to, payload) still pending
+	# from the last run, in the order they were recorded
+	def pending(self):
+		self._collect()
+		sql = "SELECT d.`id`, `user_id`, `msid`, `reply_to`, `data` FROM `deliveries` d " + \
+			"JOIN `payloads` p ON p.`id` = d.`payload` ORDER BY d.`id`"
+		with self.io_lock:
+			rows = self.db.execute(sql).fetchall()
+		ret = []
+		for rid, user_id, msid, reply_to, data in rows:
+			try:
+				ret.append((rid, user_id, msid, reply_to, json.loads(data)))
+			except ValueError:
+				logging.warning("Dropping unreadable journal record %d", rid)
+				self.ack(rid)
+		return ret
+	def register_tasks(self, sched):
+		sched.register(self.flush, seconds=1)
+		sched.register(self._collect, hours=1)
+	def close(self):
+		with self.io_lock:
+			self.flush()
+			self.db.close()
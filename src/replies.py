@@ -120,6 +120,7 @@ types = NumericEnum([
 	"ERR_POLL_NOT_ANONYMOUS",
 	"ERR_REG_CLOSED",
 	"ERR_VOICE_AND_VIDEO_PRIVACY_RESTRICTION",
+	"ERR_LOUNGE_BUSY",
 
 	"USER_INFO",
 	"USER_INFO_MOD",
@@ -266,6 +267,7 @@ format_strs = {
 	types.ERR_NOT_IN_COOLDOWN: em("This user is not in a cooldown right now."),
 	types.ERR_ACTIVE_ELSEWHERE: em("We've set this to be your currently active lounge. You will receive media here, and {lounge} media will be paused. Make sure you have uploaded enough media to register here."),
 	types.ERR_CHAT_FULL: em("Sorry, the chat is full right now. Please try again later."),
+	types.ERR_LOUNGE_BUSY: em("The lounge is very busy right now and your message was not sent. Please try again in a moment."),
 	types.ERR_BLACKLISTED: lambda reason, contact, **_:
 		em( "You've been blacklisted" + (reason and " for {reason!x}" or "") )+
 		( em("\ncontact:") + " {contact}" if contact else "" ),
@@ -403,7 +405,7 @@ format_strs = {
 		"\n" +
 		"<b>" + ("Pats" if karma_is_pats else "Karma") + ":</b> {karma}/" + ("{next_level_karma}" if next_level_karma is not None else "{level_karma}") + "\n" +
 		progress(karma, level_karma if level_karma is not None else (karma - 1), next_level_karma if next_level_karma is not None else karma),
-	types.BOT_INFO:
+	types.BOT_INFO: lambda stats, **_:
 		"<b>Python version:</b> {python_ver}\n" +
 		"<b>OS:</b> {os}\n" +
 		"\n" +
@@ -412,7 +414,8 @@ format_strs = {
 		"<b>Local time:</b> {time}\n" + # Must not use "t" conversion
 		"\n" +
 		"<b>Cached messages:</b> {cached_msgs:n}\n" +
-		"<b>Recently-active users:</b> {active_users:n}"
+		"<b>Recently-active users:</b> {active_users:n}" +
+		"".join("\n<b>%s:</b> %s" % (k, v) for k, v in stats.items())
 }
 
 localization = {}
@@ -7,10 +7,11 @@ import re
 import datetime
 import threading
 from os import path
-from ratelimit import limits, sleep_and_retry
 import src.core as core
 import src.replies as rp
-from src.util import MutablePriorityQueue, genTripcode, Scheduler, get_users_active_elsewhere, check_authorization
+from src.delivery import AsyncDelivery, ApiCall
+from src.journal import DeliveryJournal
+from src.util import MutablePriorityQueue, RateLimiter, RetryAfter, FairScheduler, RecipientIndex, LivenessProber, genTripcode, Scheduler, get_users_active_elsewhere
 from src.globals import *
 from enum import Enum
 
@@ -31,6 +32,12 @@ HIDE_FORWARD_FROM = set([
 	"Forwards_Cover_Bot", "ForwardsHideBot", "ForwardsCoversBot",
 	"NoForwardsSourceBot", "AntiForwarded_v2_Bot", "ForwardCoverzBot",
 ])
+# system notices that may be dropped when the send queue is full
+LOW_PRIORITY_NOTICES = (rp.types.KARMA_NOTIFICATION, rp.types.KARMA_LEVEL_UP, rp.types.KARMA_LEVEL_DOWN)
+ALBUM_MEDIA_TYPES = {
+	"photo": telebot.types.InputMediaPhoto, "video": telebot.types.InputMediaVideo,
+	"document": telebot.types.InputMediaDocument, "audio": telebot.types.InputMediaAudio,
+}
 VENUE_PROPS = ("title", "address", "foursquare_id", "foursquare_type", "google_place_id", "google_place_type")
 
 # module variables
@@ -41,8 +48,15 @@ shared_db = None
 ch = None
 config = None
 message_queue = None
-CALLS = 25
-RATE_LIMIT_PERIOD = 1
+queue_max_depth = 0
+overload_policies = ()
+shed_counts = {"rejected": 0, "shed": 0, "coalesced": 0}
+pending_karma = {} # maps uid -> (iid, count) of a queued karma notification
+fair = None
+delivery = None
+journal = None
+recipients = None
+prober = None
 registered_commands = {}
 tgsched = Scheduler()
 blacklisted = set()
@@ -51,6 +65,7 @@ active_elsewhere = set()
 # settings
 allow_documents = None
 allow_polls = None
+relay_copy = False
 linked_network: dict = None
 
 class AuthorizationStatus(Enum):
@@ -67,7 +82,7 @@ class AuthorizationStatus(Enum):
 
 
 def init(_config, _db, _sdb, _ch, _bot, _bl, _ae):
-	global bot, db, shared_db, ch, config, message_queue, allow_documents, allow_polls, linked_network, tgsched, blacklisted, me, active_elsewhere
+	global bot, db, shared_db, ch, config, message_queue, queue_max_depth, overload_policies, fair, journal, recipients, prober, allow_documents, allow_polls, relay_copy, linked_network, tgsched, blacklisted, me, active_elsewhere
 	max_retries = 3
 	retry_delay = 5
 	if _config["bot_token"] == "":
@@ -108,11 +123,31 @@ def init(_config, _db, _sdb, _ch, _bot, _bl, _ae):
 	active_elsewhere = _ae
 	ch = _ch
 	config = _config
-	message_queue = MutablePriorityQueue()
+	# items for the same chat are never processed concurrently, Telegram's
+	# limits are ~30 messages/s overall and ~1 message/s per chat
+	limiter = RateLimiter(config.get("send_rate", 28),
+		config.get("send_rate_per_chat", 1), config.get("send_burst_per_chat", 3))
+	message_queue = MutablePriorityQueue(key=lambda item: item.user_id, limiter=limiter,
+		indexes={"msid": lambda item: item.msid, "user_id": lambda item: item.user_id,
+			"sender": lambda item: item.sender}, on_delete=ack_item)
+	ch.on_evict = cancel_evicted
+	if config.get("delivery_journal"):
+		journal = DeliveryJournal(config["delivery_journal"])
+	if config.get("fair_queuing", False):
+		fair = FairScheduler()
+	queue_max_depth = config.get("queue_max_depth", 0)
+	overload_policies = config.get("overload_policies", ["reject", "shed", "coalesce"])
+	recipients = RecipientIndex(config)
+	recipients.rebuild(db)
+	db.observe(recipients.update)
+	prober = LivenessProber(bot, recipients.getJoined, core.force_user_leave,
+		probes_per_minute=config.get("probes_per_minute", 20),
+		ttl=datetime.timedelta(minutes=config.get("probe_ttl", 30)))
 
 	allow_contacts = config["allow_contacts"]
 	allow_documents = config["allow_documents"]
 	allow_polls = config["allow_polls"]
+	relay_copy = config.get("relay_mode", "resend") == "copy"
 	linked_network = config.get("linked_network")
 	if linked_network is not None and not isinstance(linked_network, dict):
 		logging.error("Wrong type for 'linked_network'")
@@ -171,25 +206,33 @@ def run():
 			logging.warning("%s while polling Telegram, retrying.", type(e).__name__)
 			time.sleep(1)
 
+def close():
+	if journal is not None:
+		journal.close()
+
+# stop delivering messages that were evicted from cache, their mappings
+# couldn't be saved anyway
+def cancel_evicted(ids):
+	n = message_queue.deleteBy("msid", ids)
+	if n > 0:
+		logging.warning("Failed to deliver %d messages before they were evicted from cache.", n)
+
 def register_tasks(sched):
+	if journal is not None:
+		journal.register_tasks(sched)
+	# users can also be changed by other processes (e.g. util/blacklist.py)
+	sched.register(lambda: recipients.rebuild(db), minutes=1)
 	# cache expiration
 	def task():
 		ids = ch.expire()
 		if len(ids) == 0:
 			return
-		n = 0
-		def f(item):
-			nonlocal n
-			if item.msid in ids:
-				n += 1
-				return True
-			return False
-		message_queue.delete(f)
+		n = message_queue.deleteBy("msid", ids)
 		if n > 0:
 			logging.warning("Failed to deliver %d messages before they expired from cache.", n)
 
 	#SHIN-PROVEMENT: Add a task to check for users recoreded in the hub database every hour
-	sched.register(task, hours=6) # (1/4) * cache duration
+	sched.register(task, minutes=5)
 		
 
 # Wraps a telegram user in a consistent class (used by core.py)
@@ -238,7 +281,7 @@ def send_answer(ev, m, reply_to=False):
 	def f(ev=ev, m=m):
 		while True:
 			try:
-				send_to_single_inner(ev.chat.id, m, reply_to=reply_to)
+				SendPlan(m).send(ev.chat.id, reply_to=reply_to)
 			except telebot.apihelper.ApiException as e:
 				retry = check_telegram_exc(e, None)
 				if retry:
@@ -405,16 +448,26 @@ def formatter_tripcoded_message(user: core.User, fmt: FormattedMessageBuilder):
 # Message sending (queue-related)
 
 class QueueItem():
-	__slots__ = ("user_id", "msid", "func")
-	def __init__(self, user, msid, func):
+	__slots__ = ("user_id", "msid", "sender", "tag", "rid", "func", "api_call")
+	def __init__(self, user, msid, func, api_call=None, rid=None):
 		self.user_id = None # who this item is being delivered to
 		if user is not None:
 			self.user_id = user.id
 		self.msid = msid # message id connected to this item
+		self.sender = None # who wrote the message (None for system messages)
+		if msid is not None:
+			cm = ch.getMessage(msid)
+			if cm is not None:
+				self.sender = cm.user_id
+		self.tag = None # start tag when fair queuing is enabled
+		self.rid = rid # delivery journal record
 		self.func = func
+		self.api_call = api_call # used instead of `func` by the async backend
 	def call(self):
 		try:
 			self.func()
+		except RetryAfter:
+			raise
 		except Exception as e:
 			logging.exception("Exception raised during queued message")
 
@@ -425,14 +478,88 @@ def get_priority_for(user):
 		return max(RANKS.values()) << 16
 	return user.getMessagePriority()
 
-def put_into_queue(user, msid, f):
-	message_queue.put(get_priority_for(user), QueueItem(user, msid, f))
+# returns the queue id of the item
+def put_into_queue(user, msid, f, api_call=None, rid=None):
+	item = QueueItem(user, msid, f, api_call, rid)
+	prio = get_priority_for(user)
+	if fair is not None:
+		# fair share between senders, but recipient rank still comes first
+		# and direct command replies (msid=None) aren't held back
+		item.tag = fair.vtime if msid is None else fair.tag(item.sender, msid)
+		prio = (prio >> 16, item.tag, prio & 0xffff)
+	return message_queue.put(prio, item)
+
+# whether queueing `n` more messages would go over queue_max_depth. an empty
+# queue always takes them, so a lounge with more users than that isn't stuck
+def queue_overloaded(n=1):
+	if queue_max_depth <= 0:
+		return False
+	depth = message_queue.depth()
+	return depth > 0 and depth + n > queue_max_depth
+
+# decide whether system notice `m` for User `who` should still be queued
+# while the queue is overloaded
+def admit_notice(m, who):
+	if "coalesce" in overload_policies and m.type == rp.types.KARMA_NOTIFICATION:
+		# the notification doesn't include the count, one of each kind is enough
+		pending = pending_karma.get(who.id)
+		if pending is not None and message_queue.has(pending[0]) and \
+			(pending[1] > 0) == (m.kwargs["count"] > 0):
+			shed_counts["coalesced"] += 1
+			return False
+	if "shed" in overload_policies and m.type in LOW_PRIORITY_NOTICES:
+		shed_counts["shed"] += 1
+		return False
+	return True
+
+# an item has been delivered (or failed for good) or was deleted
+def ack_item(item):
+	if journal is not None and item.rid is not None:
+		journal.ack(item.rid)
+
+def finish_item(item):
+	ack_item(item)
+	message_queue.done(item)
 
+def get_from_queue():
+	item = message_queue.get()
+	if fair is not None:
+		fair.advance(item.tag)
+	return item
 
+
+# multiple of these may run in parallel, see `send_workers`
 def send_thread():
 	while True:
-		item = message_queue.get()
-		item.call()
+		item = get_from_queue()
+		try:
+			item.call()
+		except RetryAfter as e:
+			message_queue.retry(item, e.seconds)
+			continue
+		finish_item(item)
+
+# set up the async delivery backend if configured, returns whether it is used
+def init_async_delivery(config):
+	global delivery
+	if config.get("delivery", "threads") != "async":
+		return False
+	if not AsyncDelivery.available():
+		logging.warning("Async delivery needs httpx, falling back to send threads")
+		return False
+	delivery = AsyncDelivery(config["bot_token"],
+		concurrency=config.get("async_concurrency", 100), http2=config.get("http2", False))
+	return True
+
+# feeds the queue into the async backend, replaces send_thread
+def async_send_thread():
+	threading.Thread(target=delivery.run, daemon=True).start()
+	while True:
+		item = get_from_queue()
+		delivery.submit(item, finish_item, message_queue.retry)
+
+def liveness_thread():
+	prober.run()
 
 ###
 
@@ -450,114 +577,192 @@ def should_hide_forward(ev):
 		return ev.forward_from.username in HIDE_FORWARD_FROM
 	return False
 
-def resend_message(chat_id, ev, reply_to=None, force_caption: FormattedMessage=None):
-	# Check if the message is either voice or video
-	if ev.content_type in ("video_note", "voice"):
-		# We need the full Chat object here, because some properties are not available in the ev.chat trait
-		tchat = bot.get_chat(chat_id)
-		# Check if the user has disabled them
-		if tchat.has_restricted_voice_and_video_messages:
-			return bot.send_message(chat_id, rp.formatForTelegram(rp.Reply(rp.types.ERR_VOICE_AND_VIDEO_PRIVACY_RESTRICTION)), parse_mode="HTML")
-
-	if should_hide_forward(ev):
-		pass
-	elif is_forward(ev) and (ev.content_type != "poll"):
-		# forward message instead of re-sending the contents
-		return bot.forward_message(chat_id, ev.chat.id, ev.message_id)
-
-	kwargs = {}
-	if reply_to is not None:
-		kwargs["reply_to_message_id"] = reply_to
-		kwargs["allow_sending_without_reply"] = True
-	if ev.content_type in CAPTIONABLE_TYPES:
-		if force_caption is not None:
-			kwargs["caption"] = force_caption.content
-			if force_caption.html:
-				kwargs["parse_mode"] = "HTML"
-		else:
-			kwargs["caption"] = ev.caption
-
-	# re-send message based on content type
-	if ev.content_type == "text":
-		return bot.send_message(chat_id, ev.text, **kwargs)
-	elif ev.content_type == "photo":
-		photo = sorted(ev.photo, key=lambda e: e.width*e.height, reverse=True)[0]
-		return bot.send_photo(chat_id, photo.file_id, **kwargs)
-	elif ev.content_type == "audio":
-		for prop in ("performer", "title"):
-			kwargs[prop] = getattr(ev.audio, prop)
-		return bot.send_audio(chat_id, ev.audio.file_id, **kwargs)
-	elif ev.content_type == "animation":
-		return bot.send_animation(chat_id, ev.animation.file_id, **kwargs)
-	elif ev.content_type == "document":
-		return bot.send_document(chat_id, ev.document.file_id, **kwargs)
-	elif ev.content_type == "video":
-		return bot.send_video(chat_id, ev.video.file_id, **kwargs)
-	elif ev.content_type == "voice":
-		return bot.send_voice(chat_id, ev.voice.file_id, **kwargs)
-	elif ev.content_type == "video_note":
-		return bot.send_video_note(chat_id, ev.video_note.file_id, **kwargs)
-	elif ev.content_type == "location":
-		kwargs["latitude"] = ev.location.latitude
-		kwargs["longitude"] = ev.location.longitude
-		return bot.send_location(chat_id, **kwargs)
-	elif ev.content_type == "venue":
-		kwargs["latitude"] = ev.venue.location.latitude
-		kwargs["longitude"] = ev.venue.location.longitude
-		for prop in VENUE_PROPS:
-			kwargs[prop] = getattr(ev.venue, prop)
-		return bot.send_venue(chat_id, **kwargs)
-	elif ev.content_type == "contact":
-		for prop in ("phone_number", "first_name", "last_name"):
-			kwargs[prop] = getattr(ev.contact, prop)
-		return bot.send_contact(chat_id, **kwargs)
-	elif ev.content_type == "sticker":
-		return bot.send_sticker(chat_id, ev.sticker.file_id, **kwargs)
-	elif ev.content_type == "poll":
-		return bot.forward_message(chat_id, ev.chat.id, ev.message_id)
-	else:
-		raise NotImplementedError("content_type = %s" % ev.content_type)
-
-# send a message `ev` (multiple types possible) to Telegram ID `chat_id`
-# returns the sent Telegram message
-@sleep_and_retry
-@limits(calls=CALLS, period=RATE_LIMIT_PERIOD)
-def send_to_single_inner(chat_id, ev, reply_to=None, force_caption=None, media=None):
-	if media:
-		return bot.send_media_group(chat_id, media, reply_to_message_id=reply_to)
-	if isinstance(ev, rp.Reply):
-		kwargs2 = {}
-		if reply_to is not None:
-			kwargs2["reply_to_message_id"] = reply_to
-			kwargs2["allow_sending_without_reply"] = True
-		kwargs2["disable_web_page_preview"] = True
-		return bot.send_message(chat_id, rp.formatForTelegram(ev), parse_mode="HTML", **kwargs2)
-	elif isinstance(ev, FormattedMessage):
-		kwargs2 = {}
-		if reply_to is not None:
-			kwargs2["reply_to_message_id"] = reply_to
-			kwargs2["allow_sending_without_reply"] = True
-		if ev.html:
-			kwargs2["parse_mode"] = "HTML"
-		return bot.send_message(chat_id, ev.content, **kwargs2)
-
-	return resend_message(chat_id, ev, reply_to=reply_to, force_caption=force_caption)
+def file_param(name):
+	return lambda ev: {name: getattr(ev, name).file_id}
+
+# content type -> (Bot API method, function returning its parameters)
+RESEND_TYPES = {
+	"text": ("sendMessage", lambda ev: {"text": ev.text}),
+	"photo": ("sendPhoto", lambda ev: {"photo": max(ev.photo, key=lambda e: e.width*e.height).file_id}),
+	"audio": ("sendAudio", lambda ev: {"audio": ev.audio.file_id,
+		"performer": ev.audio.performer, "title": ev.audio.title}),
+	"animation": ("sendAnimation", file_param("animation")),
+	"document": ("sendDocument", file_param("document")),
+	"video": ("sendVideo", file_param("video")),
+	"voice": ("sendVoice", file_param("voice")),
+	"video_note": ("sendVideoNote", file_param("video_note")),
+	"sticker": ("sendSticker", file_param("sticker")),
+	"location": ("sendLocation", lambda ev: {"latitude": ev.location.latitude,
+		"longitude": ev.location.longitude}),
+	"venue": ("sendVenue", lambda ev: dict(latitude=ev.venue.location.latitude,
+		longitude=ev.venue.location.longitude, **{prop: getattr(ev.venue, prop) for prop in VENUE_PROPS})),
+	"contact": ("sendContact", lambda ev: {prop: getattr(ev.contact, prop)
+		for prop in ("phone_number", "first_name", "last_name")}),
+}
+
+# How to send a message `ev` (multiple types possible), worked out once and
+# then used for every recipient.
+# `force_caption` can be a FormattedMessage to set the caption for resent media
+class SendPlan():
+	__slots__ = ("ev", "force_caption", "media", "method", "params", "bot_method", "kwargs",
+		"check_privacy", "replies")
+	def __init__(self, ev, force_caption=None, media=None):
+		self.ev = ev
+		self.force_caption = force_caption
+		self.media = media
+		self.check_privacy = False # voice and video messages can be restricted
+		self.replies = True # whether the method can reply to a message
+		self.method, self.params = self._plan(ev, force_caption, media)
+		# the same call through the bot
+		self.bot_method = None
+		self.kwargs = dict(self.params)
+		if self.method is not None:
+			self.bot_method = re.sub(r"([A-Z])", r"_\1", self.method).lower()
+		if media:
+			self.kwargs["media"] = media
+		if self.kwargs.pop("link_preview_options", None) is not None:
+			self.kwargs["disable_web_page_preview"] = True
+		if self.method == "sendVideoNote":
+			self.kwargs["data"] = self.kwargs.pop("video_note")
+	# returns (method, params) of the Bot API call without chat and reply
+	def _plan(self, ev, force_caption, media):
+		if media:
+			return "sendMediaGroup", {"media": [m.to_dict() for m in media]}
+		if isinstance(ev, rp.Reply):
+			return "sendMessage", {"text": rp.formatForTelegram(ev), "parse_mode": "HTML",
+				"link_preview_options": {"is_disabled": True}}
+		elif isinstance(ev, FormattedMessage):
+			params = {"text": ev.content}
+			if ev.html:
+				params["parse_mode"] = "HTML"
+			return "sendMessage", params
+
+		self.check_privacy = ev.content_type in ("video_note", "voice")
+		# polls can't be re-sent, they're always forwarded
+		if ev.content_type == "poll" or (is_forward(ev) and not should_hide_forward(ev)):
+			# forward message instead of re-sending the contents
+			self.replies = False
+			return "forwardMessage", {"from_chat_id": ev.chat.id, "message_id": ev.message_id}
+
+		params = {}
+		if ev.content_type in CAPTIONABLE_TYPES:
+			if force_caption is not None:
+				params["caption"] = force_caption.content
+				if force_caption.html:
+					params["parse_mode"] = "HTML"
+			elif ev.caption is not None:
+				params["caption"] = ev.caption
+		if relay_copy:
+			params["from_chat_id"] = ev.chat.id
+			params["message_id"] = ev.message_id
+			return "copyMessage", params
+		entry = RESEND_TYPES.get(ev.content_type)
+		if entry is None:
+			return None, {}
+		params.update(entry[1](ev))
+		return entry[0], params
+	# send to Telegram ID `chat_id`, returns the sent Telegram message
+	# rate limiting happens in message_queue
+	def send(self, chat_id, reply_to=None):
+		if self.check_privacy:
+			# We need the full Chat object here, because some properties are not available in the ev.chat trait
+			tchat = bot.get_chat(chat_id)
+			if tchat.has_restricted_voice_and_video_messages:
+				return bot.send_message(chat_id, rp.formatForTelegram(rp.Reply(rp.types.ERR_VOICE_AND_VIDEO_PRIVACY_RESTRICTION)), parse_mode="HTML")
+		if self.method is None:
+			raise NotImplementedError("content_type = %s" % self.ev.content_type)
+		kwargs = self.kwargs
+		if reply_to is not None and self.replies:
+			kwargs = dict(kwargs, reply_to_message_id=reply_to, allow_sending_without_reply=True)
+		return getattr(bot, self.bot_method)(chat_id, **kwargs)
+	# the same as a request for the async backend, returns (method, params)
+	# or None if it needs the bot
+	def request(self, chat_id, reply_to=None):
+		if self.method is None or self.check_privacy:
+			return None
+		params = dict(self.params, chat_id=chat_id)
+		if reply_to is not None and self.replies:
+			params["reply_parameters"] = {"message_id": reply_to, "allow_sending_without_reply": True}
+		return self.method, params
 
 # queue sending of a single message `ev` (multiple types possible) to User `user`
 # this includes saving of the sent message id to the cache mapping.
 # `reply_msid` can be a msid of the message that will be replied to
 # `force_caption` can be a FormattedMessage to set the caption for resent media
-def send_to_single(ev, msid, user, *, reply_msid=None, force_caption=None, media=None):
+# `plan` can be a SendPlan shared by all recipients of the same message
+def send_to_single(ev, msid, user, *, reply_msid=None, force_caption=None, media=None, plan=None):
+	if plan is None:
+		plan = SendPlan(ev, force_caption, media)
 	# set reply_to_message_id if applicable
 	reply_to = None
 	if reply_msid is not None:
 		reply_to = ch.lookupMapping(user.id, msid=reply_msid)
 
+	rid = None
+	# system replies (karma notices, warnings, ...) are short-lived, only
+	# relayed messages are journaled
+	if journal is not None and not isinstance(ev, rp.Reply):
+		# relays to many users share the payload
+		key = None if msid is None else (msid, id(plan))
+		rid = journal.record(user.id, msid, reply_to, key,
+			lambda: encode_payload(ev, force_caption, media))
+	return queue_send(plan, msid, user, reply_to, rid)
+
+# turn what send_to_single() gets into plain data for the delivery journal
+def encode_payload(ev, force_caption, media):
+	d = {}
+	if isinstance(ev, FormattedMessage):
+		d["formatted"] = {"html": ev.html, "content": ev.content}
+	else:
+		d["message"] = ev.json if isinstance(ev.json, dict) else json.loads(ev.json)
+	if force_caption is not None:
+		d["caption"] = {"html": force_caption.html, "content": force_caption.content}
+	if media:
+		d["media"] = [m.to_dict() for m in media]
+	return d
+
+# returns (ev, force_caption, media)
+def decode_payload(d):
+	if "formatted" in d:
+		ev = FormattedMessage(d["formatted"]["html"], d["formatted"]["content"])
+	else:
+		ev = telebot.types.Message.de_json(d["message"])
+	force_caption = None
+	if "caption" in d:
+		force_caption = FormattedMessage(d["caption"]["html"], d["caption"]["content"])
+	media = None
+	if "media" in d:
+		media = [ALBUM_MEDIA_TYPES[m["type"]](m["media"]) for m in d["media"]]
+	return ev, force_caption, media
+
+# queue deliveries left over in the journal from the last run
+def replay_journal():
+	if journal is None:
+		return
+	n = 0
+	for rid, user_id, msid, reply_to, payload in journal.pending():
+		try:
+			user = db.getUser(id=user_id)
+		except KeyError:
+			user = None
+		if user is None or not user.isJoined():
+			journal.ack(rid)
+			continue
+		# without a cache snapshot the msid may be handed out again
+		if msid is not None and ch.getMessage(msid) is None:
+			msid = None
+		plan = SendPlan(*decode_payload(payload))
+		queue_send(plan, msid, user, reply_to, rid)
+		n += 1
+	if n > 0:
+		logging.info("Replaying %d deliveries from the journal", n)
+
+def queue_send(plan, msid, user, reply_to, rid):
 	user_id = user.id
 	def f():
 		while True:
 			try:
-				ev2 = send_to_single_inner(user_id, ev, reply_to, force_caption, media=media)
+				ev2 = plan.send(user_id, reply_to)
 			except (telebot.apihelper.ApiException, telebot.apihelper.ApiTelegramException) as e:
 				retry = check_telegram_exc(e, user_id)
 				if retry:
@@ -569,7 +774,15 @@ def send_to_single(ev, msid, user, *, reply_msid=None, force_caption=None, media
 			ch.saveMapping(user_id, msid, ev2[0].message_id)
 		else:
 			ch.saveMapping(user_id, msid, ev2.message_id)
-	put_into_queue(user, msid, f)
+	# same as above for the async backend, which works on plain JSON
+	def on_result(result):
+		if isinstance(result, list):
+			result = result[0]
+		ch.saveMapping(user_id, msid, result["message_id"])
+	api_call = ApiCall(
+		lambda: plan.request(user_id, reply_to),
+		on_result, lambda e: check_telegram_exc(e, user_id))
+	return put_into_queue(user, msid, f, api_call, rid)
 
 # delete message with `id` in Telegram chat `user_id`
 def delete_message_inner(user_id, id):
@@ -584,7 +797,8 @@ def delete_message_inner(user_id, id):
 		break
 
 # look at given Exception `e`, force-leave user if bot was blocked
-# returns True if message sending should be retried
+# returns True if message sending should be retried, raises RetryAfter if
+# Telegram wants us to wait first
 def check_telegram_exc(e, user_id):
 	errmsgs = ["bot was blocked by the user", "user is deactivated",
 		"PEER_ID_INVALID", "bot can't initiate conversation"]
@@ -598,8 +812,7 @@ def check_telegram_exc(e, user_id):
 		d = min(d, 30) # supposedly this is in seconds, but you sometimes get 100 or even 2000
 		if d >= 20: # We do not need to log cooldowns of less than 20, this would flood the channel
 			logging.warning("API rate limit hit, waiting for %ds", d)
-		time.sleep(d)
-		return True # retry
+		raise RetryAfter(d)
 
 	logging.exception("API exception")
 	return False
@@ -615,19 +828,25 @@ class MyReceiver(core.Receiver):
 	@staticmethod
 	def reply(m, msid, who, except_who, reply_msid):
 		if who is not None:
-			return send_to_single(m, msid, who, reply_msid=reply_msid)
+			if isinstance(m, rp.Reply) and queue_overloaded() and not admit_notice(m, who):
+				return
+			iid = send_to_single(m, msid, who, reply_msid=reply_msid)
+			if isinstance(m, rp.Reply) and m.type == rp.types.KARMA_NOTIFICATION:
+				pending_karma[who.id] = (iid, m.kwargs["count"])
+			return
 
+		plan = SendPlan(m)
 		for user in db.iterateUsers():
 			if not user.isJoined():
 				continue
 			if user == except_who and not user.debugEnabled:
 				continue
-			send_to_single(m, msid, user, reply_msid=reply_msid)
+			send_to_single(m, msid, user, reply_msid=reply_msid, plan=plan)
 	@staticmethod
 	def delete(msids):
 		msids_set = set(msids)
 		# first stop actively delivering this message
-		message_queue.delete(lambda item: item.msid in msids_set)
+		message_queue.deleteBy("msid", msids_set)
 		# then delete all instances that have already been sent
 		msids_owner = []
 		for msid in msids:
@@ -650,26 +869,22 @@ class MyReceiver(core.Receiver):
 				user_id = user.id
 				def f(user_id=user_id, id=id):
 					delete_message_inner(user_id, id)
+				api_call = ApiCall(
+					lambda user_id=user_id, id=id: ("deleteMessage", {"chat_id": user_id, "message_id": id}),
+					on_error=lambda e: check_telegram_exc(e, None))
 				# msid=None here since this is a deletion, not a message being sent
-				put_into_queue(user, None, f)
+				put_into_queue(user, None, f, api_call)
 		# drop the mappings for this message so the id doesn't end up used e.g. for replies
 		for msid in msids_set:
 			ch.deleteMappings(msid)
 	@staticmethod
 	def stop_invoked(user, delete_out):
 		# delete pending messages to be delivered *to* the user
-		message_queue.delete(lambda item, user_id=user.id: item.user_id == user_id)
+		message_queue.deleteBy("user_id", (user.id, ))
 		if not delete_out:
 			return
 		# delete all pending messages written *by* the user too
-		def f(item):
-			if item.msid is None:
-				return False
-			cm = ch.getMessage(item.msid)
-			if cm is None:
-				return False
-			return cm.user_id == user.id
-		message_queue.delete(f)
+		message_queue.deleteBy("msid", ch.getMessages(user.id).keys())
 
 ####
 
@@ -764,7 +979,18 @@ def cmd_karmainfo(ev):
 
 def cmd_botinfo(ev):
 	c_user = UserContainer(ev.from_user)
-	send_answer(ev, core.get_bot_info(c_user), True)
+	stats = {
+		"Liveness probes/min": prober.getProbesPerMinute(),
+	}
+	stats.update(message_queue.getStats())
+	backlog = message_queue.countBy("sender")
+	backlog.pop(None, None)
+	stats["Senders with queued messages"] = len(backlog)
+	stats["Largest sender backlog"] = max(backlog.values(), default=0)
+	stats["Overload rejected/shed/coalesced"] = "%d/%d/%d" % (
+		shed_counts["rejected"], shed_counts["shed"], shed_counts["coalesced"])
+	stats.update(ch.getStats())
+	send_answer(ev, core.get_bot_info(c_user, stats), True)
 
 def cmd_version(ev):
 	send_answer(ev, rp.Reply(rp.types.PROGRAM_VERSION, version=VERSION, url_catlounge=URL_CATLOUNGE, url_secretlounge=URL_SECRETLOUNGE), True)
@@ -1081,6 +1307,13 @@ def relay_inner(ev, *, caption_text=None, signed=False, tripcode=False, ksigned=
 	blacklist_contact = config.get("blacklist_contact")
 	is_media = is_forward(ev) or ev.content_type in MEDIA_FILTER_TYPES
 
+	# the whole fan-out has to fit into the queue. the recipients are only
+	# counted here, the list is taken once the sender has been updated below
+	if queue_max_depth > 0 and "reject" in overload_policies and \
+		queue_overloaded(len(recipients.getRecipients(blacklisted, active_elsewhere if shared_db else ()))):
+		shed_counts["rejected"] += 1
+		return send_answer(ev, rp.Reply(rp.types.ERR_LOUNGE_BUSY))
+
 	msid = core.prepare_user_message(UserContainer(ev.from_user), calc_spam_score(ev),
 		is_media=is_media, signed=signed, tripcode=tripcode, ksigned=ksigned)
 	if msid is None or isinstance(msid, rp.Reply):
@@ -1180,16 +1413,9 @@ def relay_inner(ev, *, caption_text=None, signed=False, tripcode=False, ksigned=
 
 	# relay message to all other users
 	logging.debug("relay(): msid=%d reply_msid=%r", msid, reply_msid)
-	for user2 in db.iterateUsers():
-		auth_dict = check_authorization(user2, config, blacklisted, active_elsewhere, db, bot, shared_db)
-		can_receive = auth_dict['can_receive']
-		reply_status = " (SENT)" if can_receive else " (WITHHELD)"
-		reply = auth_dict['log_message'] + reply_status
-
-		#if user2.username and any(substring in user2.username for substring in ["shinanygans", "shins_bot_testing_bitch"]):
-		#	logging.info(reply)
-
-		if not can_receive:
+	plan = SendPlan(ev_tosend, force_caption, media)
+	for user2 in recipients.getRecipients(blacklisted, active_elsewhere if shared_db else ()):
+		if not prober.isAlive(user2):
 			continue
 
 		if user2 == user and not user.debugEnabled:
@@ -1197,7 +1423,7 @@ def relay_inner(ev, *, caption_text=None, signed=False, tripcode=False, ksigned=
 			continue
 
 		send_to_single(ev_tosend, msid, user2,
-			reply_msid=reply_msid, force_caption=force_caption, media=media)
+			reply_msid=reply_msid, force_caption=force_caption, media=media, plan=plan)
 
 @takesArgument()
 def cmd_sign(ev, arg):
@@ -4,9 +4,10 @@ import time
 import logging
 import os
 import inspect 
+import heapq
+from collections import deque
 from datetime import datetime
-from queue import PriorityQueue
-from threading import Lock
+from threading import Lock, RLock, Condition
 from datetime import timedelta
 import src.core as core
 import src.replies as rp
@@ -68,31 +69,340 @@ class Scheduler():
 				if wait > 0:
 					time.sleep(wait)
 
-class MutablePriorityQueue():
+# RLock that keeps track of how often and how long threads had to wait for it
+class InstrumentedLock():
+	def __init__(self):
+		self.lock = RLock()
+		self.acquisitions = 0
+		self.contended = 0
+		self.wait_time = 0.0 # seconds
+	def acquire(self):
+		if not self.lock.acquire(blocking=False):
+			start = time.perf_counter()
+			self.lock.acquire()
+			self.contended += 1
+			self.wait_time += time.perf_counter() - start
+		self.acquisitions += 1
+	def release(self):
+		self.lock.release()
+	def __enter__(self):
+		self.acquire()
+		return self
+	def __exit__(self, *args):
+		self.release()
+	def format(self):
+		return "%d/%d contended, %.2fs waited" % (self.contended, self.acquisitions, self.wait_time)
+	# counters of several locks added up, for reporting
+	@staticmethod
+	def total(locks):
+		ret = InstrumentedLock()
+		for lock in locks:
+			ret.acquisitions += lock.acquisitions
+			ret.contended += lock.contended
+			ret.wait_time += lock.wait_time
+		return ret
+
+# Raised by queued work that has to be retried after `seconds`
+class RetryAfter(Exception):
+	def __init__(self, seconds):
+		super().__init__("retry after %ds" % seconds)
+		self.seconds = seconds
+
+# Token bucket allowing `rate` operations per second with bursts of up to
+# `burst`, not thread-safe on its own
+class TokenBucket():
+	def __init__(self, rate, burst):
+		self.rate = rate
+		self.burst = burst
+		self.tokens = burst
+		self.stamp = time.monotonic()
+	def _refill(self, now):
+		if now < self.stamp:
+			return # paused
+		self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp = now
+	# hand out no tokens for `seconds`, starting empty afterwards
+	def pause(self, now, seconds):
+		self.tokens = 0
+		self.stamp = max(self.stamp, now + seconds)
+	def isFull(self, now):
+		self._refill(now)
+		return self.tokens >= self.burst
+	# seconds until a token is available
+	def delay(self, now):
+		self._refill(now)
+		if now < self.stamp:
+			return self.stamp - now + 1 / self.rate
+		if self.tokens >= 1:
+			return 0
+		return (1 - self.tokens) / self.rate
+	def take(self, now):
+		self._refill(now)
+		self.tokens -= 1
+
+# Rate limit with a global bucket and one bucket per key (e.g. chat)
+class RateLimiter():
+	def __init__(self, rate, key_rate, key_burst):
+		self.bucket = TokenBucket(rate, rate)
+		self.key_rate = key_rate
+		self.key_burst = key_burst
+		self.buckets = {} # maps key -> TokenBucket
+		self.taken = 0
+		self.throttled = deque() # (time, key) of recent pauses
+	def globalDelay(self, now):
+		return self.bucket.delay(now)
+	def keyDelay(self, key, now):
+		if key is None or key not in self.buckets.keys():
+			return 0
+		return self.buckets[key].delay(now)
+	def _bucketFor(self, key):
+		if key not in self.buckets.keys():
+			self.buckets[key] = TokenBucket(self.key_rate, self.key_burst)
+		return self.buckets[key]
+	# Telegram told us to back off for `seconds` while sending to `key`.
+	# It doesn't say whether the limit was per chat or global, so the global
+	# bucket is paused when several chats are throttled within a second.
+	def pause(self, key, now, seconds):
+		if key is None:
+			self.bucket.pause(now, seconds)
+			return
+		self._bucketFor(key).pause(now, seconds)
+		self.throttled.append((now, key))
+		while self.throttled[0][0] < now - 1:
+			self.throttled.popleft()
+		if len(set(k for _, k in self.throttled)) >= 3:
+			self.bucket.pause(now, seconds)
+	def take(self, key, now):
+		self.bucket.take(now)
+		if key is not None:
+			self._bucketFor(key).take(now)
+		# forget buckets that have refilled every now and then, they behave
+		# the same as a new one
+		self.taken += 1
+		if self.taken % 1000 == 0:
+			for key in list(self.buckets.keys()):
+				if self.buckets[key].isFull(now):
+					del self.buckets[key]
+
+# Start-time fair queuing across flows (e.g. senders of messages): every unit
+# of work (e.g. a relayed message, which becomes many queue items) gets a
+# virtual start tag. A flow with lots of queued work gets increasingly later
+# tags, so a newly active flow is served after at most one unit of each other
+# flow instead of after all of their backlog.
+class FairScheduler():
 	def __init__(self):
-		self.queue = PriorityQueue() # contains (prio, iid)
+		self.lock = Lock()
+		self.vtime = 0 # start tag of the latest item handed out
+		self.finish = {} # maps flow -> finish tag of its latest unit
+		self.last_unit = {} # maps flow -> (unit, tag), items of a unit are queued together
+	def tag(self, flow, unit, cost=1):
+		with self.lock:
+			last = self.last_unit.get(flow)
+			if last is not None and last[0] == unit:
+				return last[1]
+			tag = max(self.vtime, self.finish.get(flow, 0))
+			self.finish[flow] = tag + cost
+			self.last_unit[flow] = (unit, tag)
+			return tag
+	# an item with `tag` is now being processed
+	def advance(self, tag):
+		with self.lock:
+			if tag <= self.vtime:
+				return
+			self.vtime = tag
+			# flows that are caught up behave the same as unknown ones
+			for flow in list(self.finish.keys()):
+				if self.finish[flow] <= self.vtime:
+					del self.finish[flow]
+					self.last_unit.pop(flow, None)
+
+# Priority queue that supports deleting items and can be consumed by multiple
+# workers: items with the same key (as returned by `key`) are never handed out
+# while another one is still being processed, see done()
+# If a RateLimiter is given get() skips over items whose key has no tokens left
+# and waits if the global bucket is empty.
+# `indexes` maps index names to functions returning the value an item is
+# indexed under (or None), items can then be deleted by value with deleteBy()
+# `on_delete` is called with every item removed by delete() or deleteBy()
+class MutablePriorityQueue():
+	def __init__(self, key=None, limiter=None, indexes={}, on_delete=None):
+		self.key = key
+		self.limiter = limiter
+		self.on_delete = on_delete
+		self.indexers = indexes
+		self.indexes = {name: {} for name in indexes.keys()} # maps name -> value -> set of iids
+		self.tombstones = 0 # entries of deleted items still in heap, delayed or parked
+		self.heap = [] # contains (prio, iid)
 		self.items = {} # maps iid -> opaque
+		self.times = {} # maps iid -> when it was queued (monotonic)
 		self.counter = itertools.count()
-		# protects `items` and `counter`, `queue` has its own lock
-		self.lock = Lock()
+		self.busy = set() # keys of items currently being processed
+		self.parked = {} # maps key -> list of (prio, iid) waiting for it
+		self.delayed = [] # contains (not before, prio, iid) held back by the limiter
+		self.taken = {} # maps id(opaque) -> (prio, iid) for items being processed
+		self.rate_delays = 0
+		self.retries = 0
+		self.completed = deque() # completion times (monotonic) in the last minute
+		self.cond = Condition(Lock())
+	def _keyOf(self, data):
+		return None if self.key is None else self.key(data)
+	def _add(self, iid, data):
+		self.items[iid] = data
+		self.times[iid] = time.monotonic()
+		for name, f in self.indexers.items():
+			value = f(data)
+			if value is not None:
+				self.indexes[name].setdefault(value, set()).add(iid)
+	def _remove(self, iid):
+		data = self.items.pop(iid)
+		del self.times[iid]
+		for name, f in self.indexers.items():
+			value = f(data)
+			if value is None:
+				continue
+			iids = self.indexes[name][value]
+			iids.discard(iid)
+			if len(iids) == 0:
+				del self.indexes[name][value]
+		return data
+	def _delete(self, iid):
+		data = self._remove(iid)
+		self.tombstones += 1
+		if self.on_delete is not None:
+			self.on_delete(data)
+	def _compact(self):
+		# drop entries of deleted items once they make up most of the queue
+		if self.tombstones < max(1024, len(self.items)):
+			return
+		self.heap = list(e for e in self.heap if e[1] in self.items.keys())
+		heapq.heapify(self.heap)
+		self.delayed = list(e for e in self.delayed if e[2] in self.items.keys())
+		heapq.heapify(self.delayed)
+		for key in list(self.parked.keys()):
+			self.parked[key] = list(e for e in self.parked[key] if e[1] in self.items.keys())
+		self.tombstones = 0
+	def _undelay(self, now):
+		while len(self.delayed) > 0 and self.delayed[0][0] <= now:
+			_, prio, iid = heapq.heappop(self.delayed)
+			heapq.heappush(self.heap, (prio, iid))
+	def _timeout(self, now):
+		if len(self.delayed) == 0:
+			return None
+		return max(0, self.delayed[0][0] - now)
 	def get(self):
-		while True:
-			_, iid = self.queue.get()
-			with self.lock:
-				# skip deleted entries
-				if iid in self.items.keys():
-					return self.items.pop(iid)
+		with self.cond:
+			while True:
+				now = time.monotonic()
+				self._undelay(now)
+				timeout = self._timeout(now)
+				while len(self.heap) > 0:
+					if self.limiter is not None:
+						delay = self.limiter.globalDelay(now)
+						if delay > 0:
+							timeout = delay
+							break
+					prio, iid = heapq.heappop(self.heap)
+					# skip deleted entries
+					if iid not in self.items.keys():
+						self.tombstones -= 1
+						continue
+					key = self._keyOf(self.items[iid])
+					if key is not None and key in self.busy:
+						self.parked.setdefault(key, []).append((prio, iid))
+						continue
+					if self.limiter is not None:
+						delay = self.limiter.keyDelay(key, now)
+						if delay > 0:
+							# look at the next item instead of waiting for this one
+							heapq.heappush(self.delayed, (now + delay, prio, iid))
+							self.rate_delays += 1
+							timeout = self._timeout(now)
+							continue
+						self.limiter.take(key, now)
+					if key is not None:
+						self.busy.add(key)
+					data = self._remove(iid)
+					self.taken[id(data)] = (prio, iid)
+					return data
+				self.cond.wait(timeout)
+	def _release(self, key):
+		if key is None:
+			return
+		self.busy.discard(key)
+		parked = self.parked.pop(key, ())
+		for e in parked:
+			heapq.heappush(self.heap, e)
+		if len(parked) > 0:
+			self.cond.notify(len(parked))
+	# must be called once processing of an item returned by get() is finished
+	def done(self, data):
+		key = self._keyOf(data)
+		now = time.monotonic()
+		with self.cond:
+			self.completed.append(now)
+			while self.completed[0] < now - 60:
+				self.completed.popleft()
+			self.taken.pop(id(data), None)
+			self._release(key)
+	# instead of done(): put an item returned by get() back into the queue,
+	# to be handed out again no earlier than `seconds` from now. it keeps its
+	# place in the queue and can be deleted again like any other item
+	def retry(self, data, seconds):
+		key = self._keyOf(data)
+		now = time.monotonic()
+		with self.cond:
+			self.retries += 1
+			prio, iid = self.taken.pop(id(data))
+			self._add(iid, data)
+			heapq.heappush(self.delayed, (now + seconds, prio, iid))
+			if self.limiter is not None:
+				self.limiter.pause(key, now, seconds)
+			self._release(key)
+			self.cond.notify()
+	# returns an id that can be passed to has()
 	def put(self, prio, data):
-		with self.lock:
+		with self.cond:
 			iid = next(self.counter)
-			self.items[iid] = data
-		self.queue.put((prio, iid))
-	def delete(self, selector):
-		with self.lock:
-			keys = list(self.items.keys())
-			for iid in keys:
-				if selector(self.items[iid]):
-					del self.items[iid]
+			self._add(iid, data)
+			heapq.heappush(self.heap, (prio, iid))
+			self.cond.notify()
+		return iid
+	# is the item with id `iid` still waiting in the queue?
+	def has(self, iid):
+		return iid in self.items.keys()
+	def depth(self):
+		return len(self.items)
+	# returns dict of value -> number of queued items for index `name`
+	def countBy(self, name):
+		with self.cond:
+			return {value: len(iids) for value, iids in self.indexes[name].items()}
+	# delete all items whose value in index `name` is one of `values`,
+	# returns the number of deleted items
+	def deleteBy(self, name, values):
+		n = 0
+		with self.cond:
+			index = self.indexes[name]
+			for value in values:
+				for iid in index.get(value, ()).copy():
+					self._delete(iid)
+					n += 1
+			self._compact()
+		return n
+	def getStats(self):
+		now = time.monotonic()
+		with self.cond:
+			while len(self.completed) > 0 and self.completed[0] < now - 60:
+				self.completed.popleft()
+			# items are queued in order, apart from retries
+			oldest = next(iter(self.times.values()), now)
+			return {
+				"Send queue depth": len(self.items),
+				"Send queue oldest item": "%ds" % (now - oldest),
+				"Send queue in flight": len(self.busy),
+				"Sent/min": len(self.completed),
+				"Send queue rate limit delays": self.rate_delays,
+				"Send queue retries": self.retries,
+			}
 
 class Enum():
 	def __init__(self, m, reverse=True):
@@ -164,6 +474,181 @@ def getLastModFile(dir="", exts=("", ".py", ".txt", ".md", ".example")):
 	} for file in os.scandir(path) if file.is_file() and os.path.splitext(file)[1] in exts]
 	return max(files, key=lambda file: file["last_mod"])
 
+# In-memory index of users that are allowed to receive relayed messages.
+# This mirrors the rules of check_authorization() without its side effects or
+# Telegram API calls, so relaying doesn't need to check every user for every
+# message. It is kept up to date by observing user writes to the db, media
+# timeouts are handled by a timer heap.
+class RecipientIndex():
+	def __init__(self, config):
+		self.lock = Lock()
+		self.media_hours = config.get("media_hours", 5)
+		self.users = {} # uid -> User, only contains eligible users
+		self.joined = set() # uids of all joined users
+		self.deadlines = {} # uid -> current media timeout
+		self.timers = [] # heap of (deadline, uid) for media timeouts
+		self.pending = None # updates seen while a rebuild is reading users
+	# also picks up changes made to the database by other processes
+	# (e.g. util/blacklist.py), so it's called periodically
+	def rebuild(self, db):
+		with self.lock:
+			self.pending = {}
+		users = list(db.iterateUsers())
+		with self.lock:
+			self.users.clear()
+			self.joined.clear()
+			self.deadlines.clear()
+			self.timers.clear()
+			for user in users:
+				self._update(user)
+			# these are newer than what was just read
+			for user in self.pending.values():
+				self._update(user)
+			self.pending = None
+	def update(self, user):
+		with self.lock:
+			self._update(user)
+			if self.pending is not None:
+				self.pending[user.id] = user
+	@staticmethod
+	def _isPrivileged(user):
+		return user.rank >= RANKS.mod or (user.username is not None and "shinanygans" in user.username)
+	# returns the (UTC) point in time until which `user` may receive messages
+	# or None if the user can't receive messages at all
+	def _deadline(self, user):
+		if user.isBlacklisted() or not user.isJoined():
+			return None
+		if RecipientIndex._isPrivileged(user):
+			return datetime.max
+		if not user.registered:
+			return None
+		if self.media_hours and user.last_media:
+			return user.last_media + timedelta(hours=self.media_hours)
+		return datetime.max
+	def _update(self, user):
+		self.users.pop(user.id, None)
+		if user.isJoined() and not user.isBlacklisted():
+			self.joined.add(user.id)
+		else:
+			self.joined.discard(user.id)
+		d = self._deadline(user)
+		if d is None or d <= datetime.utcnow():
+			self.deadlines.pop(user.id, None)
+			return
+		self.users[user.id] = user
+		if d == datetime.max:
+			self.deadlines.pop(user.id, None)
+		elif self.deadlines.get(user.id) != d:
+			# activity updates come in all the time, only set up a timer if
+			# the deadline actually moved
+			self.deadlines[user.id] = d
+			heapq.heappush(self.timers, (d, user.id))
+	def _expire(self):
+		now = datetime.utcnow()
+		while len(self.timers) > 0 and self.timers[0][0] <= now:
+			d, uid = heapq.heappop(self.timers)
+			if self.deadlines.get(uid) != d:
+				continue # superseded by a later timer
+			del self.deadlines[uid]
+			user = self.users.get(uid)
+			if user is None:
+				continue
+			# the user may have posted media since this timer was set up
+			d = self._deadline(user)
+			if d is None or d <= now:
+				del self.users[uid]
+			elif d != datetime.max:
+				self.deadlines[uid] = d
+				heapq.heappush(self.timers, (d, uid))
+	# returns the list of Users a message should be relayed to
+	def getRecipients(self, blacklisted=(), active_elsewhere=()):
+		with self.lock:
+			self._expire()
+			users = list(self.users.values())
+		active_elsewhere = active_elsewhere or ()
+		return [user for user in users if user.id not in blacklisted and
+			(user.id not in active_elsewhere or RecipientIndex._isPrivileged(user))]
+	def getJoined(self):
+		with self.lock:
+			return list(self.joined)
+
+# Checks in the background whether joined users can still be reached in their
+# DMs with the bot, at most `probes_per_minute` times a minute and starting with
+# the users checked longest ago. Users that turn out unreachable are handed to
+# `on_unreachable`, relaying only consults the cached results.
+class LivenessProber():
+	def __init__(self, bot, candidates, on_unreachable, probes_per_minute=20, ttl=timedelta(minutes=30)):
+		self.lock = Lock()
+		self.bot = bot
+		self.candidates = candidates # function returning a list of uids
+		self.on_unreachable = on_unreachable
+		self.probes_per_minute = probes_per_minute
+		self.ttl = ttl
+		self.results = {} # uid -> (datetime of probe, reachable?)
+		self.history = deque() # time.monotonic() of recent probes
+	# returns False if `user` was found unreachable recently and hasn't
+	# talked to the bot since, otherwise True
+	def isAlive(self, user):
+		with self.lock:
+			e = self.results.get(user.id)
+		if e is None or e[1]:
+			return True
+		return e[0] + self.ttl < datetime.now() or user.lastActive > e[0]
+	def getProbesPerMinute(self):
+		with self.lock:
+			self._trimHistory()
+			return len(self.history)
+	def _trimHistory(self):
+		cutoff = time.monotonic() - 60
+		while len(self.history) > 0 and self.history[0] < cutoff:
+			self.history.popleft()
+	def _nextCandidate(self):
+		uids = self.candidates()
+		with self.lock:
+			never = datetime.min, True
+			uid = min(uids, key=lambda uid: self.results.get(uid, never)[0], default=None)
+			if uid is None:
+				return None
+			e = self.results.get(uid)
+			if e is not None and e[0] + self.ttl > datetime.now():
+				return None # everyone was checked recently enough
+			# forget about users that are no longer candidates
+			if len(self.results) > 2 * len(uids):
+				uids = set(uids)
+				self.results = {k: v for k, v in self.results.items() if k in uids}
+			return uid
+	def probe(self, uid):
+		with self.lock:
+			self.history.append(time.monotonic())
+			self._trimHistory()
+		try:
+			self.bot.send_chat_action(uid, "typing")
+			reachable = True
+		except telebot.apihelper.ApiTelegramException as e:
+			s = str(e).lower()
+			if not ("forbidden" in s or "chat not found" in s or "deactivated" in s):
+				logging.warning("Unexpected error while probing user %d: %s", uid, e)
+				return None
+			reachable = False
+		with self.lock:
+			self.results[uid] = (datetime.now(), reachable)
+		if not reachable:
+			logging.debug("User %d has exited the DM with the bot.", uid)
+			self.on_unreachable(uid)
+		return reachable
+	def run(self):
+		if self.probes_per_minute <= 0:
+			return
+		interval = 60 / self.probes_per_minute
+		while True:
+			try:
+				uid = self._nextCandidate()
+				if uid is not None:
+					self.probe(uid)
+			except Exception as e:
+				logging.exception("Exception raised while probing users")
+			time.sleep(interval)
+
 def get_users_active_elsewhere(shared_db, config):
 	if shared_db is None:
 		return
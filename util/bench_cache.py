@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+import sys
+import os
+import time
+import random
+import itertools
+import logging
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import src.core # resolves the import cycle between src.util and src.globals
+from src.cache import Cache, CachedMessage, MappingShard
+
+# reference implementation: mappings stored per user, deletion scans every user
+
+class NaiveShard(MappingShard):
+	def save(self, uid, msid, data):
+		if uid not in self.idmap.keys():
+			self.idmap[uid] = {}
+		if msid not in self.idmap[uid].keys():
+			self.mappings += 1
+		self.idmap[uid][msid] = data
+		return False
+	def lookup(self, uid, msid):
+		if uid not in self.idmap.keys():
+			return None
+		return self.idmap[uid].get(msid, None)
+	def lookupReverse(self, uid, data):
+		if uid not in self.idmap.keys():
+			return ()
+		gen = ( msid for msid, _data in self.idmap[uid].items() if _data == data )
+		return list(itertools.islice(gen, 1))
+	def delete(self, msid):
+		for d in self.idmap.values():
+			if d.pop(msid, None) is not None:
+				self.mappings -= 1
+	def pruneBefore(self, oldest):
+		pass
+
+class NaiveCache(Cache):
+	def __init__(self):
+		super().__init__()
+		self.shards = [NaiveShard()]
+
+def fill(ch, users, messages, fanout):
+	uids = list(range(1, users + 1))
+	old = datetime.now() - timedelta(hours=25)
+	msids = []
+	for i in range(messages):
+		cm = CachedMessage(random.choice(uids))
+		if i < messages // 2:
+			cm.time = old # first half is due for expiry
+		msids.append(ch.assignMessageId(cm))
+	# every chat has its own message ids
+	tgids = {uid: 1000 for uid in uids}
+	before = tracemalloc.get_traced_memory()[0]
+	for msid in msids:
+		for uid in random.sample(uids, fanout):
+			tgids[uid] += 1
+			ch.saveMapping(uid, msid, tgids[uid])
+	return tracemalloc.get_traced_memory()[0] - before
+
+def bench(cls, users, messages, fanout):
+	random.seed(1)
+	tracemalloc.start()
+	size = fill(cls(), users, messages, fanout)
+	tracemalloc.stop()
+	# run again without tracing to get realistic timing
+	random.seed(1)
+	ch = cls()
+	fill(ch, users, messages, fanout)
+	# look up the newest mappings of every user both ways
+	mappings = last_mappings(ch, users)
+	t = time.perf_counter()
+	for uid, tgid, msid in mappings:
+		assert ch.lookupMapping(uid, msid=msid) == tgid
+		assert ch.lookupMapping(uid, data=tgid) == msid
+	dt_lookup = time.perf_counter() - t
+	t = time.perf_counter()
+	n = len(ch.expire())
+	return size, dt_lookup, n, time.perf_counter() - t
+
+def last_mappings(ch, users, count=1000):
+	ret = []
+	for msid in reversed(list(ch.msgs.keys())):
+		for uid in range(1, users + 1):
+			tgid = ch.lookupMapping(uid, msid=msid)
+			if tgid is not None:
+				ret.append((uid, tgid, msid))
+		if len(ret) >= count:
+			break
+	return ret
+
+def main(argv):
+	logging.basicConfig(format="%(message)s", level=logging.INFO)
+	users = int(argv[0]) if len(argv) > 0 else 1000
+	messages = int(argv[1]) if len(argv) > 1 else 50000
+	fanout = int(argv[2]) if len(argv) > 2 else 20
+	logging.info("%d users, %d messages, %d recipients per message", users, messages, fanout)
+	for cls in (NaiveCache, Cache):
+		size, dt_lookup, n, dt = bench(cls, users, messages, fanout)
+		logging.info("%-10s mappings use %6.1f MiB, lookups took %.3fs, expired %d messages in %.3fs",
+			cls.__name__, size / 2**20, dt_lookup, n, dt)
+
+if __name__ == "__main__":
+	main(sys.argv[1:])